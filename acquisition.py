@@ -0,0 +1,201 @@
+from __future__ import division, print_function
+
+import threading
+
+import numpy as np
+
+from eeg_buffer import RingBuffer, chunk_array
+
+
+class AcquisitionThread(threading.Thread):
+    """ Pulls chunks from a StreamInlet on its own thread so sample intake does not wait on win.flip().
+
+    Timestamps are moved onto the local LSL clock with inlet.time_correction(), refreshed every
+    correction_interval seconds. A SampleGrid takes the jitter out of them and counts lost samples,
+    filling them in with fill_gaps, and online_filter (an OnlineFilter) filters the samples if one
+    is given, before they go into ring buffers guarded by a lock. The frame loop reads them back
+    with pull_chunk(), which has the same shape of result as StreamInlet.pull_chunk(), so an
+    AcquisitionThread can be passed anywhere an inlet was used. If pulling fails, for instance
+    because the stream was lost, the thread stops and pull_chunk() raises the exception again on
+    the caller's thread.
+    """
+
+    def __init__(self, inlet, n_channels, sample_rate, buffer_seconds=360, timeout=0.05, correction_interval=5.0,
+                 online_filter=None, fill_gaps=False):
+        # buffer_seconds matches the default max_buflen of a pylsl StreamInlet, so samples that
+        # arrive between runs are kept exactly as the inlet would have kept them
+        threading.Thread.__init__(self, name='eeg-acquisition')
+        self.daemon = True
+        self.inlet = inlet
+        self.n_channels = n_channels
+        self.timeout = timeout
+        self.overruns = 0  # samples dropped because the frame loop fell more than buffer_seconds behind
+        self.correction_interval = correction_interval
+        self.clock_offset = 0.0
+        self.grid = SampleGrid(n_channels, sample_rate, fill_gaps=fill_gaps)
+        self.online_filter = online_filter
+        self._next_correction = None
+
+        capacity = int(buffer_seconds * sample_rate)
+        self._samples = RingBuffer(n_channels, capacity)
+        self._timestamps = RingBuffer(1, capacity, dtype=np.float64)
+        self._read = 0
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._error = None
+
+    def run(self):
+        try:
+            self._acquire()
+        except Exception as e:
+            self._error = e
+
+    def _acquire(self):
+        while not self._stopped.is_set():
+            chunk, timestamps = self.inlet.pull_chunk(timeout=self.timeout)
+            if not timestamps:
+                continue
+            timestamps = np.asarray(timestamps)
+            if self._next_correction is None or timestamps[-1] >= self._next_correction:
+                self.clock_offset = self.inlet.time_correction()
+                self._next_correction = timestamps[-1] + self.correction_interval
+            samples, timestamps = self.grid.resample(chunk_array(chunk, self.n_channels), timestamps + self.clock_offset)
+            if not len(timestamps):
+                continue
+            if self.online_filter is not None:
+                samples = self.online_filter.process(samples)
+            with self._lock:
+                self._samples.append(samples)
+                self._timestamps.append(timestamps)
+
+    def pull_chunk(self):
+        """ Returns the (samples, channels) array and timestamps received since the last call. """
+        if self._error is not None:
+            raise self._error
+        with self._lock:
+            new = self._samples.total - self._read
+            if new > self._samples.capacity:
+                self.overruns += new - self._samples.capacity
+                new = self._samples.capacity
+            samples = self._samples.window(new).T.copy()
+            timestamps = self._timestamps.window(new)[0].copy()
+            self._read = self._samples.total
+        return samples, timestamps
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+class SampleGrid(object):
+    """ Dates samples by the device's own sample clock, and counts the samples the stream lost or repeated.
+
+    LSL stamps samples when their chunk is pushed, so timestamps arrive late by a jittering few
+    milliseconds. Each sample is given a slot, its index in the device's stream, and a line
+    time = intercept + period * slot is fitted by least squares to the (slot, timestamp) pairs of
+    the last fit_seconds; samples are returned with the fitted times of their slots. A block takes
+    the slots after the previous block's, and the line is only trusted to show lost or repeated
+    samples when the timestamps stay off it by the same whole number of periods for persistence
+    blocks in a row: by at least half a period, and by more than gap_tolerance times the RMS
+    residual of the fit. The blocks awaiting that decision are kept out of the fit. Jitter alone
+    rarely keeps up such an offset for long, while a real gap or repeat shifts every later block.
+    During the first second nothing is decided, since the line is not known yet.
+
+    The slots are then moved by the offset, and it is counted in dropped or duplicates. By default
+    no samples are made up or thrown away, so what is returned is what the device sent, and a gap
+    or repeat shows as a jump in the times. With fill_gaps, the missing samples are interpolated, or the
+    repeated ones skipped, at the block where the offset was confirmed, so that sample counts keep
+    track of the device's clock.
+    """
+
+    def __init__(self, n_channels, sample_rate, fit_seconds=10.0, gap_tolerance=2.0, persistence=5, fill_gaps=False):
+        self.n_channels = n_channels
+        self.sample_rate = sample_rate
+        self.gap_tolerance = gap_tolerance
+        self.persistence = persistence
+        self.fill_gaps = fill_gaps
+        self.duplicates = 0
+        self.dropped = 0
+        self._slot = -1  # slot of the last sample received
+        self._skip = 0  # repeated samples still to be skipped, with fill_gaps
+        self._origin = None  # timestamp of slot 0 until the line is fitted
+        self._last_sample = None
+        self._pending = []  # [slots, timestamps, offset] of the blocks the fit does not include yet
+        self._slots = RingBuffer(1, int(fit_seconds * sample_rate), dtype=np.float64)
+        self._times = RingBuffer(1, int(fit_seconds * sample_rate), dtype=np.float64)
+
+    def resample(self, samples, timestamps):
+        """ Takes a (samples, channels) block and its timestamps; returns the samples and the times of their slots. """
+        samples = np.asarray(samples, dtype=np.float64).reshape(-1, self.n_channels)
+        timestamps = np.asarray(timestamps, dtype=np.float64)
+        if not len(timestamps):
+            return np.zeros((0, self.n_channels)), timestamps
+        if self._origin is None:
+            self._origin = timestamps[0]
+        slots = self._slot + 1 + np.arange(len(timestamps))
+        clock = self._fit()
+        offset = None
+        if clock is not None:
+            intercept, period, _ = clock
+            offset = (timestamps[-1] - intercept) / period - slots[-1]
+        self._pending.append([slots, timestamps, offset])
+
+        shift = self._confirmed_shift(clock)
+        if shift:
+            for block in self._pending:  # every pending block is past the gap or repeat
+                block[0] += shift
+                block[2] -= shift
+            if shift > 0:
+                self.dropped += shift
+            else:
+                self.duplicates -= shift
+        while len(self._pending) > self.persistence:
+            committed_slots, committed_times, _ = self._pending.pop(0)
+            self._slots.append(committed_slots)
+            self._times.append(committed_times)
+
+        slots = self._pending[-1][0]
+        if self.fill_gaps and shift > 0 and self._last_sample is not None:
+            weight = (np.arange(1, shift + 1) / (shift + 1.0))[:, np.newaxis]
+            filled = self._last_sample + weight * (samples[:1] - self._last_sample)
+            samples = np.concatenate([filled, samples])
+            slots = np.concatenate([slots[0] - shift + np.arange(shift), slots])
+        if self.fill_gaps and shift < 0:
+            self._skip -= shift
+        if self._skip:
+            skipped = min(self._skip, len(slots))
+            self._skip -= skipped
+            samples, slots = samples[skipped:], slots[skipped:]
+        self._slot = self._pending[-1][0][-1]
+        if not len(slots):
+            return np.zeros((0, self.n_channels)), np.zeros(0)
+        self._last_sample = samples[-1:]
+
+        if clock is None:
+            return samples, self._origin + slots / self.sample_rate
+        intercept, period, _ = clock
+        return samples, intercept + period * slots
+
+    def _confirmed_shift(self, clock):
+        """ The whole number of periods the last persistence blocks all lie off the line by, or 0. """
+        offsets = [block[2] for block in self._pending[-self.persistence:]]
+        if clock is None or len(offsets) < self.persistence or None in offsets:
+            return 0
+        tolerance = clock[2]
+        if min(offsets) > tolerance:
+            return int(round(min(offsets)))
+        if max(offsets) < -tolerance:
+            return -int(round(-max(offsets)))
+        return 0
+
+    def _fit(self):
+        """ (intercept, period, tolerance) of the clock line through the committed pairs, or None during the first second. """
+        n = len(self._slots)
+        if n < self.sample_rate:
+            return None
+        slots, times = self._slots.window(n)[0], self._times.window(n)[0]
+        slot_mean, time_mean = slots.mean(), times.mean()
+        period = ((slots - slot_mean) * (times - time_mean)).sum() / ((slots - slot_mean) ** 2).sum()
+        residuals = (times - time_mean - period * (slots - slot_mean)) / period
+        tolerance = max(0.5, self.gap_tolerance * np.sqrt((residuals ** 2).mean()))
+        return time_mean - period * slot_mean, period, tolerance
@@ -0,0 +1,98 @@
+from __future__ import division, print_function
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+
+class ArtifactDetector(object):
+    """ Marks artifact samples of a stream, a chunk at a time, with a boolean mask instead of copies of the data.
+
+    A sample is an artifact if any channel is further than amplitude from zero, moved more than
+    gradient since the previous sample, spans more than peak_to_peak over the last
+    peak_to_peak_length samples, or has not changed by more than flatline_tolerance for
+    flatline_length samples. Each artifact also rejects the hold - 1 samples after it. All checks
+    run on the whole (samples, channels) chunk at once, and the state carried between chunks makes
+    the mask the same however the stream is split up. Given channels, only those columns of the
+    chunks are checked, e.g. the ones a band power is computed from.
+    """
+
+    def __init__(self, n_channels, sample_rate=125, channels=None, amplitude=80.0, peak_to_peak=150.0,
+                 peak_to_peak_length=None, gradient=50.0, flatline_length=None, flatline_tolerance=0.01, hold=25):
+        self.n_channels = n_channels
+        self.channels = list(range(n_channels)) if channels is None else list(channels)
+        self.amplitude = amplitude
+        self.peak_to_peak = peak_to_peak
+        self.peak_to_peak_length = peak_to_peak_length or int(round(0.2 * sample_rate))
+        self.gradient = gradient
+        self.flatline_length = flatline_length or int(round(0.5 * sample_rate))
+        self.flatline_tolerance = flatline_tolerance
+        self.hold = hold
+        self.onsets = np.zeros(0, dtype=np.intp)  # where in the last chunk each new artifact started
+        self._history = np.zeros((0, len(self.channels)))  # the samples before the chunk that its checks look back on
+        self._flat_run = np.zeros(len(self.channels), dtype=np.int64)
+        self._since_artifact = hold
+
+    def update(self, samples):
+        """ The clean mask of a (samples, channels) chunk: True where a sample can be used. """
+        samples = np.asarray(samples, dtype=np.float64).reshape(-1, self.n_channels)[:, self.channels]
+        n = len(samples)
+        if n == 0:
+            self.onsets = np.zeros(0, dtype=np.intp)
+            return np.ones(0, dtype=bool)
+
+        history = np.concatenate([self._history, samples])
+        previous = history[-n - 1:-n] if len(history) > n else samples[:1]
+        steps = np.abs(np.diff(np.concatenate([previous, samples]), axis=0))
+
+        artifact = (np.abs(samples) > self.amplitude).any(axis=1)
+        artifact |= (steps > self.gradient).any(axis=1)
+        artifact |= (self._peak_to_peak(history, n) > self.peak_to_peak).any(axis=1)
+        artifact |= (self._flat_runs(steps <= self.flatline_tolerance) >= self.flatline_length).any(axis=1)
+
+        # index of the latest artifact at or before each sample, the carried one being before the chunk
+        index = np.arange(n)
+        latest = np.maximum.accumulate(np.where(artifact, index, -self._since_artifact))
+        before = np.concatenate([[-self._since_artifact], latest[:-1]])
+        self.onsets = np.flatnonzero(artifact & (index - before >= self.hold))
+        self._since_artifact = min(n - latest[-1], self.hold)
+        self._history = history[-max(self.peak_to_peak_length - 1, 1):]
+        return index - latest >= self.hold
+
+    def _peak_to_peak(self, history, n):
+        """ Range of each channel over the peak_to_peak_length samples up to each new sample, as (n, channels). """
+        length = self.peak_to_peak_length
+        missing = length - 1 - (len(history) - n)
+        if missing > 0:  # the start of the stream: repeating the first sample changes no range
+            history = np.concatenate([np.repeat(history[:1], missing, axis=0), history])
+        history = np.ascontiguousarray(history[-(n + length - 1):])
+        sample_stride, channel_stride = history.strides
+        windows = as_strided(history, shape=(n, length, history.shape[1]),
+                             strides=(sample_stride, sample_stride, channel_stride))
+        return windows.max(axis=1) - windows.min(axis=1)
+
+    def _flat_runs(self, flat):
+        """ Number of consecutive flat steps ending at each sample, per channel, continuing the previous chunk's runs. """
+        index = np.arange(len(flat))[:, np.newaxis]
+        last_change = np.maximum.accumulate(np.where(flat, -1 - self._flat_run, index), axis=0)
+        runs = index - last_change
+        self._flat_run = runs[-1]
+        return runs
+
+
+def artifact_mask(eeg, sample_rate=125, channels=None, **thresholds):
+    """ The clean mask of a whole (channels, samples) recording, as the live detector would have produced it. """
+    eeg = np.asarray(eeg)
+    return ArtifactDetector(eeg.shape[0], sample_rate, channels, **thresholds).update(eeg.T)
+
+
+def clean_segments(clean, minimum_length=125):
+    """ (start, stop) of every run of at least minimum_length clean samples in a mask.
+
+    If there is none, the recording has nothing to estimate from without its artifacts, and the
+    whole of it is the one segment.
+    """
+    clean = np.asarray(clean, dtype=bool)
+    edges = np.flatnonzero(np.diff(np.concatenate([[False], clean, [False]]).astype(np.int8)))
+    segments = [(start, stop) for start, stop in zip(edges[::2], edges[1::2]) if stop - start >= minimum_length]
+    return segments or [(0, len(clean))]
+
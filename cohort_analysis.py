@@ -0,0 +1,144 @@
+from __future__ import division, print_function
+
+import csv
+import glob
+import multiprocessing
+import os
+import re
+import sys
+
+import numpy as np
+
+from edf_reader import EdfFile
+from event_log import recorded_samples
+from feedback_replay import replay_run, replay_version
+from session_store import read_group, read_questions, subject_runs
+from sham_feedback import content_digest
+
+# the live analysis, with channels given by label so it does not depend on experiment.py's montage table;
+# replay_version is part of every cached result's key, so results of older replay code are not reused
+parameters = {'replay_version': replay_version,
+              'sample_rate': 125,
+              'frames_per_bar': 30,
+              'neurofeedback_channels': ('Fp1', 'Fp2', 'Fpz', 'AF3', 'AF4', 'Fz'),
+              'baseline_channels': ('Fp1', 'Fp2', 'Fpz', 'AF3', 'AF4', 'Fz'),
+              'peak_alpha_channels': ('Oz', 'PO3', 'PO4'),
+              'artifact_gating': False,
+              'power_hop': 1,
+              'spectral_method': 'periodogram'}
+
+result_columns = ('subject', 'group', 'set', 'run', 'ipaf', 'baseline_power', 'n_bars',
+                  'feedback_mean', 'feedback_sd', 'feedback_min', 'feedback_max')
+
+
+def discover_runs(data_directory):
+    """ Every run in data_directory that has both a baseline and a trial recording, as dicts. """
+    runs = []
+    for subject_directory in sorted(glob.glob(os.path.join(data_directory, 'subject_*'))):
+        subject = int(re.search(r'subject_(\d+)', subject_directory).group(1))
+        group = read_group(subject_directory)
+        recorded = dict(((set, run, type), directory) for set, run, type, directory in subject_runs(subject_directory))
+        for (set, run, type), directory in sorted(recorded.items()):
+            if type != 'trial' or (set, run, 'baseline') not in recorded:
+                continue
+            runs.append({'subject': subject, 'group': group, 'set': set, 'run': run,
+                         'baseline_path': os.path.join(recorded[(set, run, 'baseline')], 'eeg.edf'),
+                         'trial_path': os.path.join(directory, 'eeg.edf'),
+                         'questions_path': os.path.join(os.path.dirname(directory), 'questions.csv')})
+    return sorted(runs, key=lambda run: (run['subject'], run['set'], run['run']))
+
+
+def analyse_run(baseline_path, trial_path, parameters=parameters):
+    """ replay_run() on a recorded run, looking the channels in parameters up by label. """
+    recordings = []
+    for path in (baseline_path, trial_path):
+        f = EdfFile(path)
+        try:
+            recordings.append((f.labels, f.read(0, recorded_samples(path))))
+        finally:
+            f.close()
+    labels = recordings[0][0]
+    indices = dict(parameters)
+    for key in ('neurofeedback_channels', 'baseline_channels', 'peak_alpha_channels'):
+        indices[key] = [labels.index(label) for label in parameters[key]]
+    return replay_run(recordings[0][1], recordings[1][1], indices)
+
+
+def _cached_analysis(task):
+    # runs in a pool worker: the hash is taken here too, so reading the files is spread over the pool
+    run, cache_directory, parameters = task
+    cache_path = os.path.join(cache_directory,
+                              content_digest(parameters, (run['baseline_path'], run['trial_path'])) + '.npz')
+    if os.path.exists(cache_path):
+        cached = np.load(cache_path)
+        return float(cached['ipaf']), float(cached['baseline_power']), cached['feedback_values'].tolist(), True
+
+    ipaf, baseline_power, feedback_values = analyse_run(run['baseline_path'], run['trial_path'], parameters)
+    temporary_path = '{0}.{1}.tmp.npz'.format(cache_path[:-len('.npz')], os.getpid())
+    np.savez(temporary_path, ipaf=ipaf, baseline_power=baseline_power, feedback_values=np.asarray(feedback_values))
+    os.rename(temporary_path, cache_path)
+    return ipaf, baseline_power, feedback_values, False
+
+
+def analyse_cohort(data_directory='experiment_data', cache_directory='experiment_data/analysis_cache',
+                   processes=None, parameters=parameters):
+    """ One result dict per run of every subject, computed in a process pool.
+
+    Each run's result is cached under a hash of its two EDF files, the parameters and replay_version,
+    so only runs that are new, whose recordings changed or whose replay code changed are analysed
+    again. The questionnaire answers of the run are joined on as question_0, question_1, ...
+    """
+    parameters = dict(parameters, replay_version=replay_version)
+    try:
+        os.makedirs(cache_directory)
+    except OSError:
+        if not os.path.isdir(cache_directory):
+            raise
+
+    runs = discover_runs(data_directory)
+    pool = multiprocessing.Pool(processes)
+    try:
+        analyses = pool.map(_cached_analysis, [(run, cache_directory, parameters) for run in runs], chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+    results = []
+    for run, (ipaf, baseline_power, feedback_values, cached) in zip(runs, analyses):
+        values = np.asarray(feedback_values)
+        result = {'subject': run['subject'], 'group': run['group'], 'set': run['set'], 'run': run['run'],
+                  'ipaf': ipaf, 'baseline_power': baseline_power, 'n_bars': len(values),
+                  'feedback_mean': values.mean() if len(values) else np.nan,
+                  'feedback_sd': values.std() if len(values) else np.nan,
+                  'feedback_min': values.min() if len(values) else np.nan,
+                  'feedback_max': values.max() if len(values) else np.nan,
+                  'feedback_values': feedback_values, 'cached': cached}
+        if os.path.exists(run['questions_path']):
+            for question, value in read_questions(run['questions_path']):
+                result['question_{0}'.format(question)] = value
+        results.append(result)
+    return results
+
+
+def write_results(results, path):
+    """ One row per run: result_columns, then every question column that any run has. """
+    questions = sorted(set(key for result in results for key in result if key.startswith('question_')),
+                       key=lambda key: int(key[len('question_'):]))
+    with open(path, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(result_columns + tuple(questions))
+        for result in results:
+            writer.writerow([result[column] for column in result_columns] + [result.get(key, '') for key in questions])
+
+
+def main():
+    data_directory = sys.argv[1] if len(sys.argv) > 1 else 'experiment_data'
+    results = analyse_cohort(data_directory, os.path.join(data_directory, 'analysis_cache'))
+    path = os.path.join(data_directory, 'results.csv')
+    write_results(results, path)
+    print("{0} runs, {1} analysed, {2} from the cache, written to {3}".format(
+        len(results), sum(not result['cached'] for result in results), sum(result['cached'] for result in results), path))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+from __future__ import division, print_function
+
+import errno
+import os
+
+import numpy as np
+import pyedflib
+
+
+class EdfRecording(object):
+    """ An EDF+ file that is written while the run is recorded, one data record (one second) at a time.
+
+    Samples are held only until a full second has arrived, then written straight to disk, so memory
+    stays the same however long the run is and a crash loses at most the last second. close() pads
+    the last partial second with zeros and lets pyedflib write the final record count into the header.
+    """
+
+    def __init__(self, path, labels, sample_rate, physical_range=(-100, 100), annotations_per_record=4):
+        directory = os.path.dirname(path)
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        self.path = path
+        self.labels = labels
+        self.sample_rate = sample_rate
+        self.n_samples = 0  # samples received so far, written or pending
+        self.annotations_per_record = annotations_per_record
+
+        self._writer = pyedflib.EdfWriter(path, len(labels), file_type=pyedflib.FILETYPE_EDFPLUS)
+        channel_info = []
+        for label in labels:
+            channel_dict = {'label': label,
+                            'dimension': 'uV',
+                            'sample_rate': sample_rate,
+                            'physical_max': physical_range[1],
+                            'physical_min': physical_range[0],
+                            'digital_max': 32767,
+                            'digital_min': -32768,
+                            'transducer': '',
+                            'prefilter': ''}
+            channel_info.append(channel_dict)
+        self._writer.setSignalHeaders(channel_info)
+        self._writer.set_number_of_annotation_signals(annotations_per_record)
+
+        self._record = np.zeros((len(labels), sample_rate))  # channel-major, the layout of an EDF data record
+        self._filled = 0
+
+    def append(self, samples):
+        """ Add a (samples, channels) block, writing every data record it completes. """
+        samples = np.asarray(samples, dtype=np.float64).reshape(-1, len(self.labels))
+        self.n_samples += len(samples)
+        while len(samples):
+            taken = min(len(samples), self.sample_rate - self._filled)
+            self._record[:, self._filled:self._filled + taken] = samples[:taken].T
+            self._filled += taken
+            samples = samples[taken:]
+            if self._filled == self.sample_rate:
+                self._write_record()
+
+    def annotation_capacity(self):
+        """ How many annotations the file can hold: EDF+ stores annotations_per_record in each data record. """
+        return -(-self.n_samples // self.sample_rate) * self.annotations_per_record
+
+    def annotate(self, onset, description, duration=-1):
+        """ An EDF+ annotation onset seconds after the start of the file; a duration of -1 means none. """
+        self._writer.writeAnnotation(onset, duration, description)
+
+    def _write_record(self):
+        self._writer.blockWritePhysicalSamples(self._record.ravel())
+        self._filled = 0
+
+    def close(self):
+        if self._writer is None:
+            return
+        if self._filled:
+            self._record[:, self._filled:] = 0
+            self._write_record()
+        self._writer.close()
+        self._writer = None
@@ -0,0 +1,84 @@
+from __future__ import division, print_function
+
+import numpy as np
+
+
+def chunk_array(chunk, n_channels, dtype=np.float32):
+    """ Convert a pull_chunk() result (list of samples) into a (samples, channels) array. """
+    samples = np.asarray(chunk, dtype=dtype)
+    return samples.reshape(-1, n_channels)
+
+
+class RingBuffer(object):
+    """ Preallocated (channels, samples) buffer with O(1) appends and zero-copy windows.
+
+    In ring mode every sample is written twice, at slot i and slot i + capacity, so the
+    newest `capacity` samples are always one contiguous slice and window() never copies.
+    In archive mode (growable=True) nothing is overwritten; the storage doubles when full.
+    """
+
+    def __init__(self, n_channels, capacity, dtype=np.float32, growable=False):
+        self.n_channels = n_channels
+        self.capacity = capacity
+        self.growable = growable
+        self.total = 0  # number of samples ever appended
+        self._head = 0  # next write slot (ring mode) / number of stored samples (archive mode)
+        width = capacity if growable else 2 * capacity
+        self._data = np.zeros((n_channels, width), dtype=dtype)
+
+    def __len__(self):
+        return min(self.total, self.capacity) if not self.growable else self.total
+
+    def append(self, samples):
+        """ Append a (samples, channels) block, e.g. the array from chunk_array(). """
+        samples = np.asarray(samples)
+        if samples.size == 0:
+            return
+        samples = samples.reshape(-1, self.n_channels)
+        n = len(samples)
+        if self.growable:
+            self._append_archive(samples, n)
+        else:
+            self._append_ring(samples, n)
+        self.total += n
+
+    def _append_ring(self, samples, n):
+        capacity = self.capacity
+        if n > capacity:  # only the newest samples can survive anyway
+            samples = samples[n - capacity:]
+            self._head = (self._head + n - capacity) % capacity
+            n = capacity
+        block = samples.T
+        start = self._head
+        first = min(n, capacity - start)
+        self._data[:, start:start + first] = block[:, :first]
+        self._data[:, capacity + start:capacity + start + first] = block[:, :first]
+        rest = n - first
+        if rest:
+            self._data[:, :rest] = block[:, first:]
+            self._data[:, capacity:capacity + rest] = block[:, first:]
+        self._head = (start + n) % capacity
+
+    def _append_archive(self, samples, n):
+        needed = self._head + n
+        if needed > self._data.shape[1]:
+            width = max(needed, 2 * self._data.shape[1])
+            grown = np.zeros((self.n_channels, width), dtype=self._data.dtype)
+            grown[:, :self._head] = self._data[:, :self._head]
+            self._data = grown
+        self._data[:, self._head:needed] = samples.T
+        self._head = needed
+
+    def window(self, n=None):
+        """ View of the newest n samples (all buffered samples if n is None), shape (channels, n). """
+        available = len(self)
+        if n is None or n > available:
+            n = available
+        if self.growable:
+            return self._data[:, self._head - n:self._head]
+        end = self._head + self.capacity
+        return self._data[:, end - n:end]
+
+    def data(self):
+        """ View of everything currently held, oldest sample first. """
+        return self.window()
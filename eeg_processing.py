@@ -0,0 +1,299 @@
+from __future__ import division, print_function
+
+import numpy as np
+import scipy.ndimage
+import scipy.signal
+import scipy.signal.windows
+from numpy.lib.stride_tricks import as_strided
+
+from eeg_buffer import RingBuffer
+
+sample_rate = 125 # 125Hz in 16 channel mode for openBCI
+alpha_band = (7.5, 12.5) # Hz, searched for the individual peak alpha frequency
+smoothing_window_size = 30 # alpha power values smoothed into each feedback value
+
+spectral_methods = ('periodogram', 'welch', 'multitaper')
+
+_band_bins_cache = {}
+_alpha_bins_cache = {}
+_tapers_cache = {}
+
+
+def individual_peak_alpha(samples, sample_rate=sample_rate, nperseg=None):
+    """ Power-weighted mean frequency in the alpha band along the last axis.
+
+    A (channels, samples) array, or (runs, channels, samples), gives one IPAF per channel. By default
+    the spectrum is a single rfft of the whole recording; passing nperseg uses a Welch average of
+    nperseg-long segments instead, which is steadier on long baselines.
+    """
+    samples = np.asarray(samples, dtype=np.float64)
+    if nperseg is None:
+        freqs, bins = _alpha_bins(samples.shape[-1], sample_rate)
+        power = np.abs(np.fft.rfft(samples, axis=-1)[..., bins]) ** 2
+    else:
+        freqs, power = scipy.signal.welch(samples, fs=sample_rate, nperseg=nperseg, axis=-1)
+        in_band = (freqs >= alpha_band[0]) & (freqs <= alpha_band[1])
+        freqs, power = freqs[in_band], power[..., in_band]
+    return (power * freqs).sum(axis=-1) / power.sum(axis=-1)
+
+
+def _alpha_bins(n_samples, sample_rate):
+    key = (n_samples, sample_rate)
+    if key not in _alpha_bins_cache:
+        freqs = np.fft.rfftfreq(n_samples, 1.0 / sample_rate)
+        bins = np.flatnonzero((freqs >= alpha_band[0]) & (freqs <= alpha_band[1]))
+        freqs = freqs[bins]
+        bins.setflags(write=False)
+        freqs.setflags(write=False)
+        _alpha_bins_cache[key] = (freqs, bins)
+    return _alpha_bins_cache[key]
+
+
+def eeg_power(samples, ipaf, sample_rate=sample_rate, method='periodogram'):
+    """ Power in the ipaf +/- 2.5 Hz band along the last axis, so a (channels, samples) array gives one value per channel.
+
+    The default is equal to integrating scipy.signal.periodogram() over the band with the trapezoid
+    rule, but from a single rfft over all channels and band weights cached per (window length,
+    sample_rate, ipaf). method='welch' averages Hann-windowed half-length segments overlapping by
+    half, like scipy.signal.welch(); method='multitaper' averages the DPSS tapers of a 2 Hz half
+    bandwidth. Both put every segment or taper of every channel through one rfft, with the tapers
+    cached per window length, and give lower-variance estimates than the periodogram.
+    """
+    samples = np.asarray(samples, dtype=np.float64)
+    n_samples = samples.shape[-1]
+    if n_samples == 0:
+        return np.zeros(samples.shape[:-1])
+    if method == 'periodogram':
+        bins, weights = band_bins(n_samples, ipaf, sample_rate)
+        spectrum = np.fft.rfft(samples, axis=-1)[..., bins]
+        # an elementwise sum rather than np.dot, so a row's result does not depend on the batch it came in
+        return (np.abs(spectrum) ** 2 * weights).sum(axis=-1)
+
+    tapers, step = spectral_tapers(method, n_samples, sample_rate)
+    length = tapers.shape[-1]
+    if method == 'welch':
+        n_segments = (n_samples - length) // step + 1
+        samples = np.ascontiguousarray(samples)
+        segments = as_strided(samples, shape=samples.shape[:-1] + (n_segments, length),
+                              strides=samples.strides[:-1] + (step * samples.strides[-1], samples.strides[-1]))
+    else:
+        segments = samples[..., np.newaxis, :]
+    segments = (segments - segments.mean(axis=-1, keepdims=True)) * tapers  # constant detrend, then taper
+    bins, weights = band_bins(length, ipaf, sample_rate)
+    spectrum = np.fft.rfft(segments, axis=-1)[..., bins]
+    # band_bins() weights are for a boxcar of energy length; the tapers have unit energy
+    return (np.abs(spectrum) ** 2 * weights).sum(axis=-1).mean(axis=-1) * length
+
+
+def segment_average(function, samples, segments):
+    """ function() of each (start, stop) segment along the last axis of samples, averaged weighting each by its length.
+
+    For spectral estimates such as eeg_power() and individual_peak_alpha() this is a Welch average
+    over the segments, which keeps the jumps where they would meet out of the spectrum that joining
+    them into one array would put in it.
+    """
+    lengths = np.array([stop - start for start, stop in segments], dtype=np.float64)
+    values = [function(samples[..., start:stop]) for start, stop in segments]
+    return sum(length * value for length, value in zip(lengths, values)) / lengths.sum()
+
+
+def spectral_tapers(method, n_samples, sample_rate=sample_rate, half_bandwidth=2.0):
+    """ The unit-energy tapers eeg_power() applies to an n_samples window, as (tapers, taper length), and the step between them.
+
+    welch gives one Hann window of half the window length, stepped by half of that; multitaper gives
+    the 2 * NW - 1 DPSS tapers of the whole window with NW = half_bandwidth * n_samples / sample_rate.
+    """
+    key = (method, n_samples, sample_rate, half_bandwidth)
+    if key not in _tapers_cache:
+        if method == 'welch':
+            length = max(1, n_samples // 2)
+            tapers = scipy.signal.get_window('hann', length)[np.newaxis, :]
+            step = max(1, length // 2)
+        elif method == 'multitaper':
+            nw = max(1.0, half_bandwidth * n_samples / sample_rate)
+            tapers = np.atleast_2d(scipy.signal.windows.dpss(n_samples, nw, max(1, int(2 * nw) - 1)))
+            step = n_samples
+        else:
+            raise ValueError("unknown spectral method {0!r}, expected one of {1}".format(method, spectral_methods))
+        tapers = tapers / np.sqrt((tapers ** 2).sum(axis=-1, keepdims=True))
+        tapers.setflags(write=False)  # shared through the cache
+        _tapers_cache[key] = (tapers, step)
+    return _tapers_cache[key]
+
+
+def band_bins(n_samples, ipaf, sample_rate=sample_rate):
+    """ The rfft bins eeg_power() integrates over for an n_samples window, and the weight of each bin.
+
+    Band power is then sum(weights * |X[bins]|**2): the weights fold together the periodogram's
+    density scaling, its one-sided doubling, the constant detrend and the trapezoid rule.
+    """
+    key = (n_samples, sample_rate, ipaf)
+    if key not in _band_bins_cache:
+        _band_bins_cache[key] = _band_bins(n_samples, ipaf, sample_rate)
+    return _band_bins_cache[key]
+
+
+def _band_bins(n_samples, ipaf, sample_rate):
+    f = np.fft.rfftfreq(n_samples, 1.0 / sample_rate)
+    ind_min = np.argmax(f > ipaf - 2.5)
+    ind_max = np.argmax(f > ipaf + 2.5)
+    bins = np.arange(ind_min, max(ind_min, ind_max))
+
+    weights = np.zeros(len(bins))
+    if len(bins) > 1:
+        df = np.diff(f[bins])
+        weights[:-1] += df / 2
+        weights[1:] += df / 2
+
+    scale = np.full(len(bins), 2.0 / (sample_rate * n_samples))
+    scale[bins == 0] = 0.0  # removed by the constant detrend
+    if n_samples % 2 == 0:
+        scale[bins == n_samples // 2] /= 2  # the Nyquist bin is not doubled
+    weights *= scale
+
+    bins.setflags(write=False)  # shared through the cache
+    weights.setflags(write=False)
+    return bins, weights
+
+
+class SlidingBandPower(object):
+    """ Streaming eeg_power() over the newest window_length samples of every channel.
+
+    Only the ipaf +/- 2.5 Hz DFT bins are tracked, and each new sample updates them with a sliding
+    DFT step, X_k <- (X_k - oldest + newest) * exp(2j*pi*k/N). Every `refresh` samples the bins are
+    recomputed directly from the window so floating point round-off cannot accumulate. With a
+    method other than 'periodogram', power() is eeg_power() of the window with that method. A clean
+    mask passed with the samples is kept for the same window, so clean() can tell whether the
+    power includes an artifact.
+
+    power() is only recomputed once hop new samples have arrived since it last was, and returns the
+    cached value in between; due() tells whether the next call will give a new one, so consumers
+    driven by frames can take a power only when there is new data behind it.
+    """
+
+    def __init__(self, n_channels, ipaf, window_length=sample_rate, sample_rate=sample_rate, refresh=None,
+                 method='periodogram', hop=1):
+        self.ipaf = ipaf
+        self.method = method
+        self.hop = hop
+        self.window_length = window_length
+        self.sample_rate = sample_rate
+        self.refresh = refresh or window_length
+        self.bins, self.weights = band_bins(window_length, ipaf, sample_rate)
+
+        self._twiddle = np.exp(2j * np.pi * self.bins / window_length)
+        n = np.arange(window_length)[:, np.newaxis]
+        self._basis = np.exp(-2j * np.pi * n * self.bins / window_length)  # (window, bins) DFT matrix
+        self._window = RingBuffer(n_channels, window_length, dtype=np.float64)
+        self._clean = RingBuffer(1, window_length, dtype=bool)
+        self._spectrum = np.zeros((n_channels, len(self.bins)), dtype=complex)
+        self._since_refresh = 0
+        self._power = None
+        self._power_version = 0  # self._window.total when _power was computed
+
+    def window(self):
+        return self._window.window()
+
+    def update(self, samples, clean=None):
+        """ Add a (samples, channels) block of new samples, and optionally its clean mask. """
+        samples = np.asarray(samples, dtype=np.float64)
+        if samples.size == 0:
+            return
+        samples = samples.reshape(-1, self._window.n_channels)
+        m = len(samples)
+        self._clean.append(np.ones(m, dtype=bool) if clean is None else clean)
+        if self.method != 'periodogram':  # power() works from the window itself
+            self._window.append(samples)
+            return
+        full = len(self._window) == self.window_length
+
+        if full and m < self.window_length and self._since_refresh + m < self.refresh:
+            # X <- X * w**m + sum_j (new_j - old_j) * w**(m - j), i.e. m single-sample steps at once
+            delta = samples.T - self._window.window()[:, :m]  # before the append overwrites the oldest samples
+            steps = np.power(self._twiddle, (m - np.arange(m))[:, np.newaxis])
+            self._window.append(samples)
+            self._spectrum = self._spectrum * self._twiddle ** m + np.dot(delta, steps)
+            self._since_refresh += m
+        else:
+            self._window.append(samples)
+            if len(self._window) == self.window_length:
+                self._spectrum = np.dot(self._window.window(), self._basis)
+                self._since_refresh = 0
+
+    def clean(self):
+        """ Whether no sample in the current window was masked as an artifact. """
+        return bool(self._clean.window().all())
+
+    def due(self):
+        """ Whether power() will compute a new value rather than return the cached one. """
+        return self._power is None or self._window.total - self._power_version >= self.hop
+
+    def power(self):
+        """ Band power per channel, equal to eeg_power() on each channel's window as of the last recomputation. """
+        if self.due():
+            self._power = self._compute_power()
+            self._power_version = self._window.total
+        return self._power
+
+    def _compute_power(self):
+        if self.method != 'periodogram':
+            return eeg_power(self._window.window(), self.ipaf, self.sample_rate, self.method)
+        if len(self._window) < self.window_length:  # still filling up, the window is shorter than the DFT
+            return eeg_power(self._window.window(), self.ipaf, self.sample_rate)
+        return (np.abs(self._spectrum) ** 2 * self.weights).sum(axis=-1)
+
+
+# returns the percentage that the current power is above the baseline power, smoothed by a gaussian
+def neurofeedback_value(power_values, baseline):
+    smoothed_alpha_powers = scipy.ndimage.gaussian_filter1d(power_values[len(power_values) - smoothing_window_size:], 1)
+    return feedback_percentage(smoothed_alpha_powers[len(smoothed_alpha_powers) // 2], baseline)
+
+
+def feedback_percentage(power, baseline):
+    feedback_value = ((power / baseline) - 1) * 100
+    if feedback_value > 250: # Cap feedback value at 250% of baseline, since those are certainly artifacts
+        feedback_value = 250.0
+    return feedback_value
+
+
+class FeedbackSmoother(object):
+    """ Streaming neurofeedback_value(): keeps the last window_size powers and a precomputed Gaussian kernel.
+
+    By default value() equals neurofeedback_value() on the full list of powers so far. The Gaussian is
+    centred on the middle of the window, so the feedback lags the newest power by group_delay updates
+    (14 for the 30-value window). With causal=True the kernel is the trailing half of the Gaussian
+    instead, weighting only the newest powers; group_delay is then its mean lag, about half an update
+    for sigma=1, at the cost of less smoothing.
+    """
+
+    def __init__(self, baseline, window_size=smoothing_window_size, sigma=1, causal=False):
+        self.baseline = baseline
+        self.window_size = window_size
+        self.sigma = sigma
+        self.causal = causal
+        self._history = RingBuffer(1, window_size, dtype=np.float64)
+
+        radius = int(4 * sigma + 0.5)  # the same truncation gaussian_filter1d uses
+        if causal:
+            lags = np.arange(radius, -1, -1)  # oldest first, lining up with the history
+            self._kernel = np.exp(-0.5 * (lags / sigma) ** 2)
+            self._kernel /= self._kernel.sum()
+            self._taps = slice(window_size - radius - 1, window_size)
+        else:
+            lags = window_size - 1 - window_size // 2 + np.arange(radius, -radius - 1, -1)
+            self._kernel = np.exp(-0.5 * (np.arange(-radius, radius + 1) / sigma) ** 2)
+            self._kernel /= self._kernel.sum()
+            self._taps = slice(window_size // 2 - radius, window_size // 2 + radius + 1)
+        self.group_delay = (self._kernel * lags).sum()
+
+    def update(self, power):
+        self._history.append([power])
+
+    def value(self):
+        history = self._history.window()[0]
+        if len(history) < self.window_size:  # not enough powers for the kernel to stay inside the window yet
+            if self.causal:
+                kernel = self._kernel[max(0, len(self._kernel) - len(history)):]
+                return feedback_percentage((kernel * history[-len(kernel):]).sum() / kernel.sum(), self.baseline)
+            return neurofeedback_value(history, self.baseline)
+        return feedback_percentage((self._kernel * history[self._taps]).sum(), self.baseline)
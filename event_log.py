@@ -0,0 +1,102 @@
+from __future__ import division, print_function
+
+import os
+
+import numpy as np
+
+event_types = ('fixation', 'priming_stimulus', 'eye_blink_artifact', 'feedback_bar', 'run_start', 'run_end')
+text_types = ('priming_stimulus', 'run_start')  # their values are indices into EventLog.texts
+
+event_dtype = np.dtype([('timestamp', np.float64),  # LSL clock, seconds
+                        ('sample', np.int64),  # index of the first recorded sample at or after the event
+                        ('type', np.uint8),  # index into event_types
+                        ('value', np.float64)])
+
+
+class EventLog(object):
+    """ The events of one run, kept in a preallocated structured array rather than a list of objects.
+
+    Each event stores its LSL timestamp, the sample index it falls on in the run's recording, a type
+    code from event_types and a numeric value. Text values, such as the priming word, are kept once
+    in `texts` and the event's value is their index there. Logging an event is a single row write,
+    so events can be logged every feedback bar. With an outlet every event is also pushed to it as
+    a marker, stamped with the event's timestamp.
+    """
+
+    def __init__(self, recording, clock, outlet=None, capacity=1024):
+        self.recording = recording
+        self.clock = clock
+        self.outlet = outlet
+        self.texts = []
+        self._events = np.zeros(capacity, dtype=event_dtype)
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def log(self, type, value=0.0, timestamp=None, sample=None):
+        if isinstance(value, str):
+            if value not in self.texts:
+                self.texts.append(value)
+            value = self.texts.index(value)
+        if self._count == len(self._events):
+            grown = np.zeros(2 * len(self._events), dtype=event_dtype)
+            grown[:self._count] = self._events
+            self._events = grown
+        self._events[self._count] = (self.clock() if timestamp is None else timestamp,
+                                     self.recording.n_samples if sample is None else sample,
+                                     event_types.index(type),
+                                     value)
+        self._count += 1
+        if self.outlet is not None:
+            event = self._events[self._count - 1]
+            self.outlet.push_sample([self.description(event)], event['timestamp'])
+
+    def data(self):
+        return self._events[:self._count]
+
+    def description(self, event):
+        type = event_types[event['type']]
+        if type in text_types:
+            return '{0}: {1}'.format(type, self.texts[int(event['value'])])
+        return '{0}: {1:g}'.format(type, event['value'])
+
+    def annotate(self):
+        """ Write the events into the recording as EDF+ annotations; call before the recording is closed.
+
+        The file only has room for a few annotations per second, so if there are more events than
+        that the last ones are left out of the EDF file; save() always keeps all of them.
+        """
+        events = self.data()
+        capacity = self.recording.annotation_capacity()
+        if len(events) > capacity:
+            print("{0} of {1} events did not fit in {2} as annotations".format(
+                len(events) - capacity, len(events), self.recording.path))
+        for event in events[:capacity]:
+            self.recording.annotate(event['sample'] / self.recording.sample_rate, self.description(event))
+
+    def save(self, path):
+        """ Writes the whole log as one .npz: the events array, the type names, the text values and the
+        number of samples recorded, which the EDF file pads up to a whole second.
+        """
+        np.savez(path, events=self.data(), types=np.array(event_types), texts=np.array(self.texts),
+                 n_samples=np.array(self.recording.n_samples))
+
+
+def recorded_samples(edf_path):
+    """ How many samples of the EDF file were recorded, from the events.npz saved next to it; None if unknown.
+
+    Logs saved before n_samples was stored fall back to the sample of their run_end event.
+    """
+    path = os.path.join(os.path.dirname(edf_path), 'events.npz')
+    if not os.path.exists(path):
+        return None
+    log = np.load(path)
+    try:
+        if 'n_samples' in log.files:
+            return int(log['n_samples'])
+        events = log['events']
+        run_end = events[events['type'] == list(log['types']).index('run_end')]
+        return int(run_end['sample'][-1]) if len(run_end) else None
+    finally:
+        log.close()
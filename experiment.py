@@ -1,30 +1,71 @@
 from __future__ import print_function
 
-from psychopy import visual
-from psychopy import core, gui, data, event
-from psychopy.tools.filetools import fromFile, toFile
-import time, numpy as np, random
-import scipy.signal
-import pyedflib
+from startup import BackgroundTask, LazyValue, StartupReport
+startup = StartupReport()  # printed just before the first run
+
+with startup.step('import psychopy'):
+    from psychopy import visual
+    from psychopy import core, gui, data, event
+    from psychopy.tools.filetools import fromFile, toFile
+with startup.step('import numpy'):
+    import numpy as np, random
 import os
 import errno
-import scipy.ndimage.filters as filters
 
-from pylsl import StreamInlet, resolve_stream
-from pylsl import StreamInfo, StreamOutlet
-
-import matplotlib.pyplot as plt
-import matlab.engine
-
-eng = matlab.engine.start_matlab()
+with startup.step('import pylsl'):
+    from pylsl import StreamInlet, resolve_stream, local_clock
+    from pylsl import StreamInfo, StreamOutlet
+
+with startup.step('import experiment modules'):  # includes scipy and pyedflib
+    from acquisition import AcquisitionThread
+    from online_filter import OnlineFilter
+    from eeg_buffer import RingBuffer, chunk_array
+    from edf_recording import EdfRecording
+    from event_log import EventLog
+    from lsl_streams import ExperimentOutlets
+    from feedback_graph import FeedbackGraph
+    from frame_timing import FrameTimer
+    from features import feature_registry
+    from artifacts import ArtifactDetector, artifact_mask, clean_segments
+    from eeg_processing import FeedbackSmoother, eeg_power, individual_peak_alpha, segment_average
+    from live_feedback import LiveFeedback
+    from sham_feedback import ShamFeedbackCache
+    from edf_reader import EdfFile
+    from spatial_filter import Leadfield, spatial_filter
+    from virtual_channels import ChannelSelection, VirtualChannels
+
+def start_matlab():
+    import matlab.engine
+    return matlab.engine.start_matlab()
+
+# nothing on the Python path needs MATLAB, so the engine is only started if something asks for it
+matlab_engine = LazyValue(start_matlab)
+
+# the lead fields are only loaded once a run with source feedback needs them
+leadfield = LazyValue(Leadfield)
 
 sample_rate = 125 # 125Hz in 16 channel mode for openBCI
 frames_per_bar = 30 # how many frames per feedback update
+spectral_method = 'periodogram' # or 'welch' or 'multitaper', see eeg_power()
+power_hop = 1 # new samples needed before band powers and features are recomputed; frames in between reuse them
 window_x = 3840
 window_y = 2160
 
 text_height = 28
 
+# filter the amplifier's raw EEG stream here, with the filters of test_acquisition.xml; set to False
+# to read the stream OpenViBE filters and republishes instead
+filter_in_process = True
+# the amplifier's raw EEG stream, as the property and value resolve_stream() looks it up by; a name,
+# or ('source_id', ...) to pin one amplifier when several are on the network
+raw_eeg_stream = ('name', 'obci_eeg1')
+
+# leave the samples the artifact detector rejects out of the baselines, and hold the feedback on the
+# last clean band power while it rejects the window; off until its thresholds are calibrated, since
+# on noisy recordings they reject most windows, freeze the feedback and strip most of the baseline.
+# The same switch covers both, so the feedback is never compared with a baseline cleaned differently.
+artifact_gating = False
+
 channels = {'Fpz': 0,
             'Fp1': 1,
             'AF3': 2,
@@ -60,9 +101,14 @@ peak_alpha_channels = [channels["Oz"],
                        channels["PO3"],
                        channels["PO4"]]
 
+# runs, as (set, run), whose feedback is the alpha power of a beamformed virtual channel at the
+# posterior cingulate rather than the mean alpha power of neurofeedback_channels
+source_feedback_runs = set()
+
 index2channel = {}
 for channel, channel_number in channels.items():
     index2channel[channel_number] = channel
+channel_labels = [index2channel[index] for index in range(len(channels))]
 
 # Experiment Details
 # 1. Meditation without feedback (2 runs, 4 minutes each)
@@ -78,6 +124,9 @@ for channel, channel_number in channels.items():
 subject_id = 1
 
 def main():
+    # resolving the EEG stream can take a while, so it happens while the dialogs are up
+    eeg_connection = BackgroundTask(connect_to_EEG)
+
     try:  # try to get a previous parameters file
         expInfo = fromFile('lastParams.test')
     except:  # if not there then use a default set
@@ -101,13 +150,21 @@ def main():
     else:
         core.quit()  # the user hit cancel so exit
 
-    inlet, outlet = connect_to_EEG()
+    with startup.step('connect to EEG (after the dialog)'):
+        stream_inlet, outlet = eeg_connection.result()
+
+    # pull samples on a background thread so acquisition is not tied to the display's vsync;
+    # the trial loops read from it exactly like they would from the StreamInlet
+    online_filter = OnlineFilter(len(channels), sample_rate) if filter_in_process else None
+    inlet = AcquisitionThread(stream_inlet, len(channels), sample_rate, online_filter=online_filter)
+    inlet.start()
 
     #read stimuli adjectives for baseline task
     priming_stimuli = read_priming_stimuli()
 
     #set up experiment window
-    win = visual.Window([window_x,window_y], allowGUI=True, monitor='testMonitor', units='pix', fullscr=False)
+    with startup.step('open window'):
+        win = visual.Window([window_x,window_y], allowGUI=True, monitor='testMonitor', units='pix', fullscr=False)
 
     subject_id = expInfo["subject_id"]
     stimuli_index = 0
@@ -124,13 +181,31 @@ def main():
     participant_info['group'] = expInfo["group"]
     save_participant_details(participant_info, subject_id)
 
+    # compute every sham trace this session will need in the background while the first runs are going
+    sham_feedback = ShamFeedbackCache('experiment_data/sham_cache', {'sample_rate': sample_rate,
+                                                                     'frames_per_bar': frames_per_bar,
+                                                                     'neurofeedback_channels': neurofeedback_channels,
+                                                                     'baseline_channels': baseline_channels,
+                                                                     'peak_alpha_channels': peak_alpha_channels,
+                                                                     'artifact_gating': artifact_gating,
+                                                                     'power_hop': power_hop,
+                                                                     'spectral_method': spectral_method})
+    if expInfo["group"] == "sham":
+        with startup.step('start sham precompute'):
+            sham_feedback.precompute([sham_source_paths(subject_id, set, run)
+                                      for set, runs in [(1, 4), (2, 4), (3, 2), (4, 3), (5, 3)] for run in range(runs)])
+
+    timer = FrameTimer()  # per-frame timing of every run, saved next to its eeg.edf
+    startup.print_summary()
+
     further_instructions(win, 1)
 
     # 1. Meditation without feedback (2 runs, 4 minutes each)
     for i in range(2):
-        baseline, ipaf, eeg, events = show_baseline(win, inlet, outlet, priming_stimuli[stimuli_index][0])
+        recording = open_recording(subject_id, 0, i, 'baseline')
+        baseline, ipaf, events = show_baseline(win, inlet, outlet, priming_stimuli[stimuli_index][0], timer, recording)
         win.flip()
-        save_edf(eeg, events, subject_id, 0, i, 'baseline')
+        close_recording(recording, events, timer)
 
         message1 = visual.TextStim(win, pos=[0, +50],
                                    text='Perform the meditation practice while keeping your eyes focused on the dot in the center of the screen',
@@ -141,8 +216,9 @@ def main():
         win.flip()
         event.waitKeys()
 
-        eeg, events = show_no_feedback(win, inlet, outlet, baseline, ipaf)
-        save_edf(eeg, events, subject_id, 0, i, 'trial')
+        recording = open_recording(subject_id, 0, i, 'trial')
+        events = show_no_feedback(win, inlet, outlet, baseline, ipaf, timer, recording)
+        close_recording(recording, events, timer)
 
         show_meditation_only_questions(win, subject_id, 0, i)
         stimuli_index += 1
@@ -150,9 +226,11 @@ def main():
     further_instructions(win, 2)
     # 2. Meditation with offline feedback (feedback graph shown offline after each run; 4 runs, 1.5 minutes each)
     for i in range(4):
-        baseline, ipaf, eeg, events = show_baseline(win, inlet, outlet, priming_stimuli[stimuli_index][0])
+        recording = open_recording(subject_id, 1, i, 'baseline')
+        baseline, ipaf, events = show_baseline(win, inlet, outlet, priming_stimuli[stimuli_index][0], timer, recording)
         win.flip()
-        save_edf(eeg, events, subject_id, 1, i, 'baseline')
+        close_recording(recording, events, timer)
+        feedback_channels, baseline = select_feedback_channels(recording, 1, i, baseline, ipaf)
 
         message1 = visual.TextStim(win, pos=[0, +40], text='Please perform the instructed attention practice', height=text_height)
         message2 = visual.TextStim(win, pos=[0, -40], text="Press a key when ready.", height=text_height)
@@ -161,12 +239,12 @@ def main():
         win.flip()
         event.waitKeys()
 
-        eeg, events, feedback_stimuli, feedback_values = show_offline_neurofeedback(win, inlet, outlet, baseline, ipaf)
+        recording = open_recording(subject_id, 1, i, 'trial')
+        events, feedback_stimuli, feedback_values = show_offline_neurofeedback(win, inlet, outlet, baseline, ipaf, feedback_channels, timer, recording)
         if expInfo["group"] == "sham":
-            feedback_values = feedback_values_from_eeg(subject_id, 1, i)
-            feedback_stimuli = stimuli_from_neurofeedback_values(win, feedback_values, 5400, (
-                (5400 - 90) / frames_per_bar))
-        save_edf(eeg, events, subject_id, 1, i, 'trial')
+            feedback_values = feedback_values_from_eeg(sham_feedback, subject_id, 1, i)
+            feedback_stimuli = [feedback_graph(win, 5400, feedback_values)]
+        close_recording(recording, events, timer)
         show_run_feedback_questions(win, feedback_stimuli, feedback_values, subject_id, 1, i)
         if i == 4:
             show_final_feedback_questions(win, 1, i)
@@ -175,12 +253,14 @@ def main():
     further_instructions(win, 3)
     # 3. Meditation with real-time feedback (4 runs, 1.5 minutes each)
     for i in range(4):
-        baseline, ipaf, eeg, events = show_baseline_with_graph(win, inlet, outlet, priming_stimuli[stimuli_index][0])
+        recording = open_recording(subject_id, 2, i, 'baseline')
+        baseline, ipaf, events = show_baseline_with_graph(win, inlet, outlet, priming_stimuli[stimuli_index][0], timer, recording)
         win.flip()
-        save_edf(eeg, events, subject_id, 2, i, 'baseline')
+        close_recording(recording, events, timer)
+        feedback_channels, baseline = select_feedback_channels(recording, 2, i, baseline, ipaf)
 
         if expInfo["group"] == "sham":
-            sham_values = feedback_values_from_eeg(subject_id, 2, i)
+            sham_values = feedback_values_from_eeg(sham_feedback, subject_id, 2, i)
 
         message1 = visual.TextStim(win, pos=[0, +40], text='Please perform the instructed attention practice', height=text_height)
         message2 = visual.TextStim(win, pos=[0, -40], text="Press a key when ready.", height=text_height)
@@ -189,11 +269,12 @@ def main():
         win.flip()
         event.waitKeys()
 
+        recording = open_recording(subject_id, 2, i, 'trial')
         if expInfo["group"] == "sham":
-            eeg, events, feedback_stimuli, feedback_values = show_sham_feedback(win, inlet, outlet, sham_values)
+            events, feedback_stimuli, feedback_values = show_sham_feedback(win, inlet, outlet, sham_values, timer, recording)
         else:
-            eeg, events, feedback_stimuli, feedback_values = show_neurofeedback(win, inlet, outlet, baseline, ipaf)
-        save_edf(eeg, events, subject_id, 2, i, 'trial')
+            events, feedback_stimuli, feedback_values = show_neurofeedback(win, inlet, outlet, baseline, ipaf, feedback_channels, timer, recording)
+        close_recording(recording, events, timer)
         show_run_feedback_questions(win, feedback_stimuli, feedback_values, subject_id, 2, i)
         if i == 4:
             show_final_feedback_questions(win, subject_id, 2, i)
@@ -202,11 +283,13 @@ def main():
     further_instructions(win, 4)
     # 4. "Free-play" session. Participants are allowed to experiment with the feedback, using strategies of their own choosing. (2 runs, 7 minutes each).
     for i in range(2):
-        baseline, ipaf, eeg, events = show_baseline_with_graph(win, inlet, outlet, priming_stimuli[stimuli_index][0])
+        recording = open_recording(subject_id, 3, i, 'baseline')
+        baseline, ipaf, events = show_baseline_with_graph(win, inlet, outlet, priming_stimuli[stimuli_index][0], timer, recording)
         win.flip()
-        save_edf(eeg, events, subject_id, 3, i, 'baseline')
+        close_recording(recording, events, timer)
+        feedback_channels, baseline = select_feedback_channels(recording, 3, i, baseline, ipaf)
         if expInfo["group"] == "sham":
-            sham_values = feedback_values_from_eeg(subject_id, 3, i)
+            sham_values = feedback_values_from_eeg(sham_feedback, subject_id, 3, i)
 
         message1 = visual.TextStim(win, pos=[0, +40], text='Experiment with methods to manipulate the graph', height=text_height)
         message2 = visual.TextStim(win, pos=[0, -40], text="Press a key when ready.", height=text_height)
@@ -214,22 +297,25 @@ def main():
         message2.draw()
         win.flip()
         event.waitKeys()
+        recording = open_recording(subject_id, 3, i, 'trial')
         if expInfo["group"] == "sham":
-            eeg, events = show_sham_neurofeedback_free_play(win, inlet, outlet, sham_values)
+            events = show_sham_neurofeedback_free_play(win, inlet, outlet, sham_values, timer, recording)
         else:
-            eeg, events = show_neurofeedback_free_play(win, inlet, outlet, baseline, ipaf)
-        save_edf(eeg, events, subject_id, 3, i, 'trial')
+            events = show_neurofeedback_free_play(win, inlet, outlet, baseline, ipaf, feedback_channels, timer, recording)
+        close_recording(recording, events, timer)
         stimuli_index += 1
 
     further_instructions(win, 5)
     # 5. Volitional control in direction of effortless awareness
     for i in range(3):
-        baseline, ipaf, eeg, events = show_baseline_with_graph(win, inlet, outlet, priming_stimuli[stimuli_index][0])
-        save_edf(eeg, events, subject_id, 4, i, 'baseline')
+        recording = open_recording(subject_id, 4, i, 'baseline')
+        baseline, ipaf, events = show_baseline_with_graph(win, inlet, outlet, priming_stimuli[stimuli_index][0], timer, recording)
+        close_recording(recording, events, timer)
+        feedback_channels, baseline = select_feedback_channels(recording, 4, i, baseline, ipaf)
 
         win.flip()
         if expInfo["group"] == "sham":
-            sham_values = feedback_values_from_eeg(subject_id, 4, i)
+            sham_values = feedback_values_from_eeg(sham_feedback, subject_id, 4, i)
 
         message1 = visual.TextStim(win, pos=[0, +50], text='Please try to make the graph go in the direction that you think corresponds to increased effortlessness of awareness', height=text_height)
         message2 = visual.TextStim(win, pos=[0, -40], text="Press a key when ready.", height=text_height)
@@ -238,11 +324,12 @@ def main():
         win.flip()
         event.waitKeys()
 
+        recording = open_recording(subject_id, 4, i, 'trial')
         if expInfo["group"] == "sham":
-            eeg, events, feedback_stimuli, feedback_values = show_sham_feedback(win, inlet, outlet, sham_values)
+            events, feedback_stimuli, feedback_values = show_sham_feedback(win, inlet, outlet, sham_values, timer, recording)
         else:
-            eeg, events, feedback_stimuli, feedback_values = show_neurofeedback(win, inlet, outlet, baseline, ipaf)
-        save_edf(eeg, events, subject_id, 4, i, 'trial')
+            events, feedback_stimuli, feedback_values = show_neurofeedback(win, inlet, outlet, baseline, ipaf, feedback_channels, timer, recording)
+        close_recording(recording, events, timer)
         show_run_feedback_questions(win, feedback_stimuli, feedback_values, subject_id, 2, i)
         if i == 3:
             show_final_feedback_questions(win, subject_id, 2, i)
@@ -251,12 +338,14 @@ def main():
     further_instructions(win, 6)
     # 6. Volitional control in direction of opposite effortless awareness
     for i in range(3):
-        baseline, ipaf, eeg, events = show_baseline_with_graph(win, inlet, outlet, priming_stimuli[stimuli_index][0])
+        recording = open_recording(subject_id, 5, i, 'baseline')
+        baseline, ipaf, events = show_baseline_with_graph(win, inlet, outlet, priming_stimuli[stimuli_index][0], timer, recording)
         win.flip()
-        save_edf(eeg, events, subject_id, 5, i, 'baseline')
+        close_recording(recording, events, timer)
+        feedback_channels, baseline = select_feedback_channels(recording, 5, i, baseline, ipaf)
 
         if expInfo["group"] == "sham":
-            sham_values = feedback_values_from_eeg(subject_id, 5, i)
+            sham_values = feedback_values_from_eeg(sham_feedback, subject_id, 5, i)
 
 
         message1 = visual.TextStim(win, pos=[0, +50], text='Please try to make the graph go in the direction that you think corresponds to decreased effortlessness of awareness', height=text_height)
@@ -266,12 +355,13 @@ def main():
         win.flip()
         event.waitKeys()
 
+        recording = open_recording(subject_id, 5, i, 'trial')
         if expInfo["group"] == "sham":
-            eeg, events, feedback_stimuli, feedback_values = show_sham_feedback(win, inlet, outlet, sham_values)
+            events, feedback_stimuli, feedback_values = show_sham_feedback(win, inlet, outlet, sham_values, timer, recording)
         else:
-            eeg, events, feedback_stimuli, feedback_values = show_neurofeedback(win, inlet, outlet, baseline, ipaf)
+            events, feedback_stimuli, feedback_values = show_neurofeedback(win, inlet, outlet, baseline, ipaf, feedback_channels, timer, recording)
 
-        save_edf(eeg, events, subject_id, 5, i, 'trial')
+        close_recording(recording, events, timer)
         show_run_feedback_questions(win, feedback_stimuli, feedback_values, subject_id, 2, i)
         if i == 3:
             show_final_feedback_questions(win, subject_id, 2, i)
@@ -279,16 +369,19 @@ def main():
 
     thank_you_message(win)
 
+    inlet.stop()
+    print("EEG stream: {0} samples dropped, {1} duplicated, {2} lost to overruns".format(
+        inlet.grid.dropped, inlet.grid.duplicates, inlet.overruns))
+    sham_feedback.close()
     win.close()
     core.quit()
 
-def show_baseline(win, inlet, outlet, priming_stimulus):
+def show_baseline(win, inlet, outlet, priming_stimulus, timer, recording):
 
     # show some priming stimuli while recording baseline data
     priming_length = 1200 # 20 seconds
     fixation_length = 60 # 1 second
     stimulus_length = 180 # 3 seconds
-    artifact_length_remaining = 0
     bars = 0
 
     message1 = visual.TextStim(win, pos=[0,+40],text='Consider how the following word describes you', height=text_height)
@@ -303,58 +396,61 @@ def show_baseline(win, inlet, outlet, priming_stimulus):
     fixation = visual.GratingStim(win, color=-1, colorSpace='rgb',
                                   tex=None, mask='circle', size=20)
 
-    full_eeg = [[] for i in range(len(channels))]
-    full_eeg_no_artifacts = [[] for i in range(len(channels))]
+    baseline_samples = (priming_length + fixation_length + stimulus_length) // 60 * sample_rate
+    full_eeg = RingBuffer(len(channels), baseline_samples, growable=True)
+    full_eeg_clean = RingBuffer(1, baseline_samples, dtype=bool, growable=True)  # the artifact mask of full_eeg
+    artifact_detector = ArtifactDetector(len(channels), sample_rate, baseline_channels)
 
-    events = []
+    events = EventLog(recording, local_clock, outlet)
 
     trialClock = core.Clock()
-    events.append(EEGEvent("fixation", 0, fixation_length/60))
+    events.log("fixation", fixation_length/60)
+    events.log("run_start", recording.path)
+    timer.start()
     for frameN in range(priming_length + fixation_length + stimulus_length):
         chunk, timestamps = inlet.pull_chunk()
+        timer.mark('pull_chunk')
 
         if 0 <= frameN < fixation_length:  # present fixation for a subset of frames
             fixation.draw()
         if fixation_length <= frameN < stimulus_length + fixation_length:
             if frameN == fixation_length + 1:
-                events.append(EEGEvent("priming_stimulus", trialClock.getTime(), priming_stimulus))
+                events.log("priming_stimulus", priming_stimulus)
             visual.TextStim(win, pos=[0, 0], text=priming_stimulus, height=text_height).draw()  # trait-adjective
 
         if fixation_length + stimulus_length <= frameN < priming_length + fixation_length + stimulus_length:  # present stim for a different subset
-            for sample in chunk:  # put new samples in the eeg buffer
-                frontal_samples = [sample[i] for i in baseline_channels]
-                if max(frontal_samples) > 80:
-                    events.append(EEGEvent("eye_blink_artifact", 0, 1))
-                    artifact_length_remaining = 25
-                    # print("eye blink")
-
-                if artifact_length_remaining == 0:
-                    for index, channel_data in enumerate(sample):
-                        full_eeg_no_artifacts[index].append(channel_data)
-                else:
-                    artifact_length_remaining -= 1
-
-                for index, channel_data in enumerate(sample):
-                    full_eeg[index].append(channel_data)
-
+            samples = chunk_array(chunk, len(channels))
+            clean = artifact_detector.update(samples)
+            for index in artifact_detector.onsets:  # log each artifact once, where it starts
+                events.log("eye_blink_artifact", 1, timestamps[index], recording.n_samples + index)
+            full_eeg.append(samples)
+            full_eeg_clean.append(clean)
+            recording.append(samples)
+            timer.mark('features')
+
+        timer.mark('draw')
         win.flip()
+        timer.mark('flip')
+    events.log("run_end")
 
+    full_eeg = full_eeg.data()
+    segments = clean_segments(full_eeg_clean.data()[0], sample_rate) if artifact_gating else [(0, full_eeg.shape[1])]
     frontal_eeg = [full_eeg[i] for i in baseline_channels]
 
-    peak_alpha = np.mean(map(lambda samples: individual_peak_alpha(samples), [full_eeg[i] for i in peak_alpha_channels]))
+    peak_alpha = np.mean(segment_average(individual_peak_alpha, full_eeg[peak_alpha_channels], segments))
 
-    baseline_frontal_alpha_power = np.mean(map(lambda samples: eeg_power(samples, peak_alpha), [full_eeg[i] for i in baseline_channels]))
+    baseline_frontal_alpha_power = np.mean(segment_average(lambda eeg: eeg_power(eeg, peak_alpha, method=spectral_method),
+                                                           full_eeg[baseline_channels], segments))
 
-    return baseline_frontal_alpha_power, peak_alpha, full_eeg, events
+    return baseline_frontal_alpha_power, peak_alpha, events
 
-def show_baseline_with_graph(win, inlet, outlet, priming_stimulus):
+def show_baseline_with_graph(win, inlet, outlet, priming_stimulus, timer, recording):
 
     # show some priming stimuli while recording baseline data
     # priming_length = 240
     priming_length = 1200 # 20 seconds
     fixation_length = 60 # 1 second
     stimulus_length = 180 # 3 seconds
-    artifact_length_remaining = 0
     bars = 0
 
     feedback_values = baseline_feedback(win, priming_length, 190)
@@ -380,11 +476,13 @@ def show_baseline_with_graph(win, inlet, outlet, priming_stimulus):
     fixation = visual.GratingStim(win, color=-1, colorSpace='rgb',
                                   tex=None, mask='circle', size=20)
 
-    full_eeg = [[] for i in range(len(channels))]
-    full_eeg_no_artifacts = [[] for i in range(len(channels))]
-    events = []
+    baseline_samples = (priming_length + fixation_length + stimulus_length) // 60 * sample_rate
+    full_eeg = RingBuffer(len(channels), baseline_samples, growable=True)
+    full_eeg_clean = RingBuffer(1, baseline_samples, dtype=bool, growable=True)  # the artifact mask of full_eeg
+    artifact_detector = ArtifactDetector(len(channels), sample_rate, baseline_channels)
+    events = EventLog(recording, local_clock, outlet)
     trialClock = core.Clock()
-    events.append(EEGEvent("fixation", 0, fixation_length/60))
+    events.log("fixation", fixation_length/60)
 
     trialClock = core.Clock()
     lastFPS = 1
@@ -395,36 +493,40 @@ def show_baseline_with_graph(win, inlet, outlet, priming_stimulus):
 
     win.setRecordFrameIntervals(True)
 
-    feedback_stimuli = []
+    feedback_stimuli = [feedback_graph(win, priming_length)]
+    no_band_powers = np.full(len(neurofeedback_channels), np.nan)  # the values shown are not computed here
+    shown_value = np.nan
+    events.log("run_start", recording.path)
+    timer.start()
     for frameN in range(priming_length + fixation_length + stimulus_length):
         chunk, timestamps = inlet.pull_chunk()
+        timer.mark('pull_chunk')
 
         if 0 <= frameN < fixation_length:  # present fixation for a subset of frames
             fixation.draw()
         if fixation_length <= frameN < stimulus_length + fixation_length:
             if frameN == fixation_length + 1:
-                events.append(EEGEvent("priming_stimulus", trialClock.getTime(), priming_stimulus))
+                events.log("priming_stimulus", priming_stimulus)
             visual.TextStim(win, pos=[0, 0], text=priming_stimulus, height=text_height).draw()  # trait-adjective
 
         if fixation_length + stimulus_length <= frameN <= priming_length + fixation_length + stimulus_length:  # present stim for a different subset
-            for sample in chunk:  # put new samples in the eeg buffer
-                frontal_samples = [sample[i] for i in baseline_channels]
-                if max(frontal_samples) > 80:
-                    events.append(EEGEvent("eye_blink_artifact", 0, 1))
-                    artifact_length_remaining = 25
-
-                if artifact_length_remaining == 0:
-                    for index, channel_data in enumerate(sample):
-                        full_eeg_no_artifacts[index].append(channel_data)
-                else:
-                    artifact_length_remaining -= 1
-
-                for index, channel_data in enumerate(sample):
-                    full_eeg[index].append(channel_data)
+            samples = chunk_array(chunk, len(channels))
+            clean = artifact_detector.update(samples)
+            for index in artifact_detector.onsets:  # log each artifact once, where it starts
+                events.log("eye_blink_artifact", 1, timestamps[index], recording.n_samples + index)
+            full_eeg.append(samples)
+            full_eeg_clean.append(clean)
+            recording.append(samples)
+            timer.mark('features')
 
             if frameN % frames_per_bar == 0:
                 bar = ((frameN - fixation_length - stimulus_length) / frames_per_bar) + 1  # the nth bar of the feedback
-                feedback_stimuli = stimuli_from_neurofeedback_values(win, feedback_values[:bar], priming_length, bar - 1)
+                feedback_stimuli[0].extend(feedback_values[bar - 1:bar])
+                for value in feedback_values[bar - 1:bar]:
+                    events.log("feedback_bar", value)
+                    shown_value = value
+                timer.mark('stimuli')
+            push_features(outlet, no_band_powers, shown_value)
 
             for stimulus in feedback_stimuli:
                 stimulus.draw()
@@ -437,64 +539,73 @@ def show_baseline_with_graph(win, inlet, outlet, priming_stimulus):
         # message.text = "%ifps, [Esc] to quit" % lastFPS
         # message.draw()
 
+        timer.mark('draw')
         win.flip()
+        timer.mark('flip')
+    events.log("run_end")
 
+    full_eeg = full_eeg.data()
+    segments = clean_segments(full_eeg_clean.data()[0], sample_rate) if artifact_gating else [(0, full_eeg.shape[1])]
     frontal_eeg = [full_eeg[i] for i in baseline_channels]
     last_eeg = map(lambda channel: channel[len(channel)-125:], frontal_eeg)
 
-    peak_alpha = np.mean(map(lambda samples: individual_peak_alpha(samples), [full_eeg[i] for i in peak_alpha_channels]))
+    peak_alpha = np.mean(segment_average(individual_peak_alpha, full_eeg[peak_alpha_channels], segments))
 
-    baseline_frontal_alpha_power = np.mean(map(lambda samples: eeg_power(samples, peak_alpha), [full_eeg[i] for i in baseline_channels]))
+    baseline_frontal_alpha_power = np.mean(segment_average(lambda eeg: eeg_power(eeg, peak_alpha, method=spectral_method),
+                                                           full_eeg[baseline_channels], segments))
 
-    return baseline_frontal_alpha_power, peak_alpha, full_eeg, events
+    return baseline_frontal_alpha_power, peak_alpha, events
 
-def show_no_feedback(win, inlet, outlet, priming_stimulus, ipaf):
+def show_no_feedback(win, inlet, outlet, priming_stimulus, ipaf, timer, recording):
     fixation = visual.GratingStim(win, color=-1, colorSpace='rgb',
                                   tex=None, mask='circle', size=20)
 
 
 
-    full_eeg = [[] for i in range(len(channels))]
-    events = []
+    events = EventLog(recording, local_clock, outlet)
 
     # show some priming stimuli while recording baseline data
     meditation_length = 14400
     fixation_length = 60
 
+
     trialClock = core.Clock()
-    events.append(EEGEvent("fixation", 0, fixation_length / 60))
+    events.log("fixation", fixation_length / 60)
+    events.log("run_start", recording.path)
+    timer.start()
     for frameN in range(meditation_length):
         chunk, timestamps = inlet.pull_chunk()
-
-        for sample in chunk:  # put new samples in the eeg buffer
-            for index, channel_data in enumerate(sample):
-                full_eeg[index].append(channel_data)
+        timer.mark('pull_chunk')
+        recording.append(chunk_array(chunk, len(channels)))  # put new samples in the eeg file
+        timer.mark('features')
 
         if 0 <= frameN < meditation_length:  # present fixation for a subset of frames
             fixation.draw()
+        timer.mark('draw')
         win.flip()
+        timer.mark('flip')
+    events.log("run_end")
 
-    return full_eeg, events
+    return events
 
-def show_neurofeedback(win, inlet, outlet, baseline, ipaf):
+def show_neurofeedback(win, inlet, outlet, baseline, ipaf, feedback_channels, timer, recording):
     neurofeedback_length = 5400 # 1.5 minutes
     fixation_length = 120
 
-    neurofeedback_eeg_buffer = [[] for i in range(len(neurofeedback_channels))]
-    full_eeg = [[] for i in range(len(channels))]
-    events = []
+    feedback = LiveFeedback(channel_labels, feedback_channels, ipaf, baseline, sample_rate, spectral_method, power_hop,
+                            artifact_gating)
+    events = EventLog(recording, local_clock, outlet)
 
     message = visual.TextStim(win, pos=(-window_x/2 +50, window_y/2 - 50), text = '[Esc] to quit', color = 'white', alignHoriz = 'left', alignVert = 'bottom', height=text_height)
 
-    neurofeedback_stimuli = []
+    neurofeedback_stimuli = [feedback_graph(win, neurofeedback_length)]
     neurofeedback_values = []
-    alpha_powers = []
 
     fixation = visual.GratingStim(win, color=-1, colorSpace='rgb',
                                   tex=None, mask='circle', size=20)
 
     line = baseline_line_stimulus(win)
-    events.append(EEGEvent("fixation", 0, fixation_length/60))
+    events.log("fixation", fixation_length/60)
     # trialClock = core.Clock()
     # lastFPS = 1
     #
@@ -503,30 +614,29 @@ def show_neurofeedback(win, inlet, outlet, baseline, ipaf):
     #
     # win.setRecordFrameIntervals(True)
 
+    events.log("run_start", recording.path)
+    timer.start()
     for frameN in range(neurofeedback_length + fixation_length):
         chunk, timestamp = inlet.pull_chunk()
-        if len(neurofeedback_eeg_buffer[0]) + len(chunk) >= sample_rate:  # more than 1 second worth of samples in the buffer
-            for index, channel in enumerate(neurofeedback_eeg_buffer):
-                neurofeedback_eeg_buffer[index] = channel[len(chunk):] #take chunk size of samples out of buffer
-
-        for sample in chunk: #put new samples in the eeg buffer
-            for index, channel in enumerate(neurofeedback_channels):
-                neurofeedback_eeg_buffer[index].append(sample[channel])
-            for index, channel_data in enumerate(sample):
-                full_eeg[index].append(channel_data)
+        timer.mark('pull_chunk')
+        samples = chunk_array(chunk, len(channels))
+        feedback.update(samples)
+        recording.append(samples)
+        timer.mark('features')
 
         if frameN < fixation_length:  # present fixation while initial eeg data collected, so FFT makes sense
             fixation.draw()
         if fixation_length <= frameN < neurofeedback_length + fixation_length:
-            buffer_alpha_powers = map(lambda channel: eeg_power(channel, ipaf), neurofeedback_eeg_buffer)
-            alpha_power = np.mean(buffer_alpha_powers)
-            alpha_powers.append(alpha_power)
+            feedback.frame()
+            timer.mark('features')
 
             if frameN % frames_per_bar == 0:  # make a new stimulus bar every frames_per_bar frames
                 # use gaussian smoothed alpha power to determine neurofeedback value
-                neurofeedback_values.append(neurofeedback_value(alpha_powers, baseline))
-                bar = ((frameN - fixation_length) / frames_per_bar)  # the nth bar of the feedback
-                neurofeedback_stimuli = stimuli_from_neurofeedback_values(win, neurofeedback_values, neurofeedback_length, bar)
+                neurofeedback_values.append(feedback.value())
+                events.log("feedback_bar", neurofeedback_values[-1])
+                neurofeedback_stimuli[0].append(neurofeedback_values[-1])
+                timer.mark('stimuli')
+            push_live_features(outlet, feedback, neurofeedback_values)
 
             for stimulus in neurofeedback_stimuli:
                 stimulus.draw()
@@ -538,77 +648,76 @@ def show_neurofeedback(win, inlet, outlet, baseline, ipaf):
             # message.text = "%ifps, [Esc] to quit" % lastFPS
             # message.draw()
 
+        timer.mark('draw')
         win.flip()
+        timer.mark('flip')
+    events.log("run_end")
 
-    return full_eeg, events, neurofeedback_stimuli, neurofeedback_values
+    return events, neurofeedback_stimuli, neurofeedback_values
 
-def show_offline_neurofeedback(win, inlet, outlet, baseline, ipaf):
-    neurofeedback_eeg_buffer = [[] for i in range(len(neurofeedback_channels))]
-    full_eeg = [[] for i in range(len(channels))]
-    events = []
+def show_offline_neurofeedback(win, inlet, outlet, baseline, ipaf, feedback_channels, timer, recording):
+    feedback = LiveFeedback(channel_labels, feedback_channels, ipaf, baseline, sample_rate, spectral_method, power_hop,
+                            artifact_gating)
+    events = EventLog(recording, local_clock, outlet)
     neurofeedback_stimuli = []
     neurofeedback_values = []
-    alpha_powers = []
 
     fixation = visual.GratingStim(win, color=-1, colorSpace='rgb',
                                   tex=None, mask='circle', size=20)
 
-    smoothing_window_size = 30
     neurofeedback_length = 5400
 
     fixation_length = 120
-    events.append(EEGEvent("fixation", 0, fixation_length/60))
+    events.log("fixation", fixation_length/60)
 
+    events.log("run_start", recording.path)
+    timer.start()
     for frameN in range(neurofeedback_length + fixation_length):
         chunk, timestamp = inlet.pull_chunk()
-        if len(neurofeedback_eeg_buffer[0]) + len(
-                chunk) >= sample_rate:  # more than 1 second worth of samples in the buffer
-            for index, channel in enumerate(neurofeedback_eeg_buffer):
-                neurofeedback_eeg_buffer[index] = channel[len(chunk):]  # take chunk size of samples out of buffer
-
-        for sample in chunk:  # put new samples in the eeg buffer
-            for index, channel in enumerate(neurofeedback_channels):
-                neurofeedback_eeg_buffer[index].append(sample[channel])
-            for index, channel_data in enumerate(sample):
-                full_eeg[index].append(channel_data)
+        timer.mark('pull_chunk')
+        samples = chunk_array(chunk, len(channels))
+        feedback.update(samples)
+        recording.append(samples)
+        timer.mark('features')
 
         if 0 <= frameN < fixation_length:  # present fixation while initial eeg data collected, so FFT makes sense
             fixation.draw()
         if fixation_length <= frameN < neurofeedback_length:
-            buffer_alpha_powers = map(lambda channel: eeg_power(channel, ipaf), neurofeedback_eeg_buffer)
-            alpha_power = np.mean(buffer_alpha_powers)
-            alpha_powers.append(alpha_power)
+            feedback.frame()
+            timer.mark('features')
 
             if frameN % frames_per_bar == 0:  # make a new stimulus bar every frames_per_bar frames
                 # use gaussian smoothed alpha power to determine neurofeedback value
-                neurofeedback_values.append(neurofeedback_value(alpha_powers, baseline))
+                neurofeedback_values.append(feedback.value())
+                events.log("feedback_bar", neurofeedback_values[-1])
+            push_live_features(outlet, feedback, neurofeedback_values)
         fixation.draw()
 
+        timer.mark('draw')
         win.flip()
+        timer.mark('flip')
+    events.log("run_end")
 
-    feedback_area_width = (window_x - window_x / 10)
-    neurofeedback_stimuli = stimuli_from_neurofeedback_values(win, neurofeedback_values, neurofeedback_length, ((neurofeedback_length - fixation_length) / frames_per_bar))
-    return full_eeg, events, neurofeedback_stimuli, neurofeedback_values
+    neurofeedback_stimuli = [feedback_graph(win, neurofeedback_length, neurofeedback_values)]
+    return events, neurofeedback_stimuli, neurofeedback_values
 
-def show_neurofeedback_free_play(win, inlet, outlet, baseline, ipaf):
-    neurofeedback_eeg_buffer = [[] for i in range(len(neurofeedback_channels))]
-    full_eeg = [[] for i in range(len(channels))]
-    events = []
+def show_neurofeedback_free_play(win, inlet, outlet, baseline, ipaf, feedback_channels, timer, recording):
+    feedback = LiveFeedback(channel_labels, feedback_channels, ipaf, baseline, sample_rate, spectral_method, power_hop,
+                            artifact_gating)
+    events = EventLog(recording, local_clock, outlet)
 
-    neurofeedback_stimuli = []
-    alpha_powers = []
 
     fixation = visual.GratingStim(win, color=-1, colorSpace='rgb',
                                   tex=None, mask='circle', size=20)
 
-    smoothing_window_size = 30
     neurofeedback_length = 25200  # 7 minutes
     visible_neurofeedback_length = 1200
     fixation_length = 120
 
     line = baseline_line_stimulus(win)
+    neurofeedback_stimuli = [feedback_graph(win, visible_neurofeedback_length)]
 
-    events.append(EEGEvent("fixation", 0, fixation_length / 60))
+    events.log("fixation", fixation_length / 60)
 
     trialClock = core.Clock()
     lastFPS = 1
@@ -621,34 +730,29 @@ def show_neurofeedback_free_play(win, inlet, outlet, baseline, ipaf):
 
 
     neurofeedback_values = []
+    events.log("run_start", recording.path)
+    timer.start()
     for frameN in range(neurofeedback_length + fixation_length):
         chunk, timestamp = inlet.pull_chunk()
-        if len(neurofeedback_eeg_buffer[0]) + len(chunk) >= sample_rate:  # more than 1 second worth of samples in the buffer
-            for index, channel in enumerate(neurofeedback_eeg_buffer):
-                neurofeedback_eeg_buffer[index] = channel[len(chunk):]  # take chunk size of samples out of buffer
-
-        for sample in chunk:  # put new samples in the eeg buffer
-            for index, channel in enumerate(neurofeedback_channels):
-                neurofeedback_eeg_buffer[index].append(sample[channel])
-            for index, channel_data in enumerate(sample):
-                full_eeg[index].append(channel_data)
+        timer.mark('pull_chunk')
+        samples = chunk_array(chunk, len(channels))
+        feedback.update(samples)
+        recording.append(samples)
+        timer.mark('features')
 
         if frameN < fixation_length:  # present fixation while initial eeg data collected, so FFT makes sense
             fixation.draw()
         if fixation_length <= frameN < neurofeedback_length + fixation_length:
-            buffer_alpha_powers = map(lambda channel: eeg_power(channel, ipaf), neurofeedback_eeg_buffer)
-            alpha_power = np.mean(buffer_alpha_powers)
-            alpha_powers.append(alpha_power)
+            feedback.frame()
+            timer.mark('features')
 
             if frameN % frames_per_bar == 0:  # make a new stimulus bar every frames_per_bar frames
                 # use gaussian smoothed alpha power to determine neurofeedback value
-                neurofeedback_values.append(neurofeedback_value(alpha_powers, baseline))
-                bar = ((frameN - fixation_length) / frames_per_bar)  # the nth bar of the feedback
-                total_bars = ((visible_neurofeedback_length) / frames_per_bar)
-                if bar >= total_bars:
-                    bar = total_bars - 1
-                neurofeedback_stimuli = stimuli_from_neurofeedback_values(win, neurofeedback_values[-total_bars:], visible_neurofeedback_length, bar)
-                # events.append(EEGEvent("neurofeedback_new_bar", trialClock.getTime(), neurofeedback_value))
+                neurofeedback_values.append(feedback.value())
+                events.log("feedback_bar", neurofeedback_values[-1])
+                neurofeedback_stimuli[0].append(neurofeedback_values[-1])  # scrolls once the visible length is full
+                timer.mark('stimuli')
+            push_live_features(outlet, feedback, neurofeedback_values)
 
             for stimulus in neurofeedback_stimuli:
                 stimulus.draw()
@@ -662,14 +766,15 @@ def show_neurofeedback_free_play(win, inlet, outlet, baseline, ipaf):
         # message.draw()
 
 
+        timer.mark('draw')
         win.flip()
+        timer.mark('flip')
+    events.log("run_end")
 
-    return full_eeg, events
+    return events
 
-def show_sham_neurofeedback_free_play(win, inlet, outlet, feedback_values):
-    neurofeedback_eeg_buffer = [[] for i in range(len(neurofeedback_channels))]
-    full_eeg = [[] for i in range(len(channels))]
-    events = []
+def show_sham_neurofeedback_free_play(win, inlet, outlet, feedback_values, timer, recording):
+    events = EventLog(recording, local_clock, outlet)
 
     fixation = visual.GratingStim(win, color=-1, colorSpace='rgb',
                                   tex=None, mask='circle', size=20)
@@ -679,8 +784,9 @@ def show_sham_neurofeedback_free_play(win, inlet, outlet, feedback_values):
     fixation_length = 120
 
     line = baseline_line_stimulus(win)
+    feedback_stimuli = [feedback_graph(win, visible_neurofeedback_length)]
 
-    events.append(EEGEvent("fixation", 0, fixation_length / 60))
+    events.log("fixation", fixation_length / 60)
 
     trialClock = core.Clock()
     lastFPS = 1
@@ -692,18 +798,16 @@ def show_sham_neurofeedback_free_play(win, inlet, outlet, feedback_values):
 
     win.setRecordFrameIntervals(True)
 
+    no_band_powers = np.full(len(neurofeedback_channels), np.nan)  # the values shown are not computed here
+    shown_value = np.nan
+    events.log("run_start", recording.path)
+    timer.start()
     for frameN in range(neurofeedback_length + fixation_length):
         chunk, timestamp = inlet.pull_chunk()
-        if len(neurofeedback_eeg_buffer[0]) + len(
-                chunk) >= sample_rate:  # more than 1 second worth of samples in the buffer
-            for index, channel in enumerate(neurofeedback_eeg_buffer):
-                neurofeedback_eeg_buffer[index] = channel[len(chunk):]  # take chunk size of samples out of buffer
-
-        for sample in chunk:  # put new samples in the eeg buffer
-            for index, channel in enumerate(neurofeedback_channels):
-                neurofeedback_eeg_buffer[index].append(sample[channel])
-            for index, channel_data in enumerate(sample):
-                full_eeg[index].append(channel_data)
+        timer.mark('pull_chunk')
+        samples = chunk_array(chunk, len(channels))
+        recording.append(samples)
+        timer.mark('features')
 
         if frameN < fixation_length:  # present fixation while initial eeg data collected, so FFT makes sense
             fixation.draw()
@@ -712,18 +816,13 @@ def show_sham_neurofeedback_free_play(win, inlet, outlet, feedback_values):
 
             if frameN % frames_per_bar == 0:
                 bar = ((frameN - fixation_length) / frames_per_bar)  # the nth bar of the feedback
-                virtual_bar = bar
-                total_bars = ((visible_neurofeedback_length) / frames_per_bar)
-                if bar >= total_bars:
-                    virtual_bar = total_bars
-                    feedback_stimuli = stimuli_from_neurofeedback_values(win, feedback_values[(bar - total_bars):bar],
-                                                                         visible_neurofeedback_length, virtual_bar - 1)
-                else:
-                    feedback_stimuli = stimuli_from_neurofeedback_values(win, feedback_values[0:bar],
-                                                                         visible_neurofeedback_length, virtual_bar - 1)
-
-
-                # feedback_stimuli = stimuli_from_neurofeedback_values(win, feedback_values[-total_bars:], visible_neurofeedback_length, bar)
+                if bar > 0:
+                    feedback_stimuli[0].extend(feedback_values[bar - 1:bar])  # scrolls once the visible length is full
+                    for value in feedback_values[bar - 1:bar]:
+                        events.log("feedback_bar", value)
+                        shown_value = value
+                timer.mark('stimuli')
+            push_features(outlet, no_band_powers, shown_value)
 
             for stimulus in feedback_stimuli:
                 stimulus.draw()
@@ -734,43 +833,56 @@ def show_sham_neurofeedback_free_play(win, inlet, outlet, feedback_values):
                 lastFPSupdate = t
             message.text = "%ifps, [Esc] to quit" % lastFPS
             message.draw()
+        timer.mark('draw')
         win.flip()
+        timer.mark('flip')
+    events.log("run_end")
 
-    return full_eeg, events
+    return events
 
-def show_sham_feedback(win, inlet, outlet, feedback_values):
+def show_sham_feedback(win, inlet, outlet, feedback_values, timer, recording):
     neurofeedback_length = 5400 # 1.5 minutes
     fixation_length = 120
-    full_eeg = [[] for i in range(len(channels))]
-    events = []
+    events = EventLog(recording, local_clock, outlet)
 
     fixation = visual.GratingStim(win, color=-1, colorSpace='rgb',
                                   tex=None, mask='circle', size=20)
 
     line = baseline_line_stimulus(win)
 
-    feedback_stimuli = []
+    feedback_stimuli = [feedback_graph(win, neurofeedback_length)]
 
+    no_band_powers = np.full(len(neurofeedback_channels), np.nan)  # the values shown are not computed here
+    shown_value = np.nan
+    events.log("run_start", recording.path)
+    timer.start()
     for frameN in range(neurofeedback_length + fixation_length):
         chunk, timestamp = inlet.pull_chunk()
-
-        for sample in chunk:  # put new samples in the eeg buffer
-            for index, channel_data in enumerate(sample):
-                full_eeg[index].append(channel_data)
+        timer.mark('pull_chunk')
+        recording.append(chunk_array(chunk, len(channels)))  # put new samples in the eeg file
+        timer.mark('features')
 
         if frameN < fixation_length:  # present fixation while initial eeg data collected, so FFT makes sense
             fixation.draw()
         if fixation_length <= frameN < neurofeedback_length + fixation_length:
             if frameN % frames_per_bar == 0:
                 bar = ((frameN - fixation_length) / frames_per_bar) + 1  # the nth bar of the feedback
-                feedback_stimuli = stimuli_from_neurofeedback_values(win, feedback_values[:bar], neurofeedback_length, bar - 1)
+                feedback_stimuli[0].extend(feedback_values[bar - 1:bar])
+                for value in feedback_values[bar - 1:bar]:
+                    events.log("feedback_bar", value)
+                    shown_value = value
+                timer.mark('stimuli')
+            push_features(outlet, no_band_powers, shown_value)
 
             for stimulus in feedback_stimuli:
                 stimulus.draw()
             line.draw()
 
+        timer.mark('draw')
         win.flip()
-    return full_eeg, events, feedback_stimuli, feedback_values
+        timer.mark('flip')
+    events.log("run_end")
+    return events, feedback_stimuli, feedback_values
 
 def show_meditation_only_questions(win, subject_id, set, run):
     answers = []
@@ -1038,28 +1150,6 @@ def show_final_feedback_questions(win, subject_id, set, run):
         for index, answer in enumerate(answers):
             writer.writerow([index, answer])
 
-def individual_peak_alpha(samples):
-    ps = np.abs(np.fft.fft(samples)) ** 2  # power spectrum
-
-    time_step = 1.0 / sample_rate
-    freqs = np.fft.fftfreq(len(samples), time_step)
-    idx = np.argsort(freqs)
-
-    peak_alpha = 0.0
-    total_power = 0
-    for freq, power in zip(freqs[idx], ps[idx]):
-        if freq >= 7.5 and freq <= 12.5:
-            peak_alpha += freq * power
-            total_power += power
-
-    return peak_alpha / total_power
-
-def eeg_power(samples, ipaf):
-    f, Pxx = scipy.signal.periodogram(samples, fs=sample_rate)
-    ind_min = scipy.argmax(f > ipaf - 2.5)
-    ind_max = scipy.argmax(f > ipaf + 2.5)
-    return scipy.trapz(Pxx[ind_min: ind_max], f[ind_min: ind_max])
-
 def baseline_feedback(win, priming_length, baseline):
     from random import random as rand
 
@@ -1077,104 +1167,54 @@ def baseline_feedback(win, priming_length, baseline):
             channel.append(rand()* 40 - 20 + alpha + beta + delta + gamma + theta)
 
         i += 1
+    feedback_signal = np.asarray(feedback_signal)
 
     feedback_stimuli = []
-    alpha_powers = []
+    alpha_power_smoother = FeedbackSmoother(baseline)  # keeps only the powers the smoothing needs
     ipaf = 10
-    smoothing_window_size = 30
 
     neurofeedback_values = []
     # just do it sort of like the live version
     for frame in range(priming_length):
-        buffer = map(lambda channel: channel[int(round(frame * (sample_rate/60))):int(round((frame + 60) * (sample_rate/60)))], feedback_signal)
+        buffer = feedback_signal[:, int(round(frame * (sample_rate/60))):int(round((frame + 60) * (sample_rate/60)))]
 
-        buffer_alpha_powers = map(lambda channel: eeg_power(channel, ipaf), buffer)
-        alpha_power = np.mean(buffer_alpha_powers)
-        alpha_powers.append(alpha_power)
+        alpha_power = np.mean(eeg_power(buffer, ipaf))
+        alpha_power_smoother.update(alpha_power)
 
         if frame % frames_per_bar == 0:  # make a new stimulus bar every frames_per_bar frames
             # use gaussian smoothed alpha power to determine neurofeedback value
-            neurofeedback_values.append(neurofeedback_value(alpha_powers, baseline) * 10)
+            neurofeedback_values.append(alpha_power_smoother.value() * 10)
 
     return neurofeedback_values
 
-def feedback_values_from_eeg(subject_id, set, run):
-    baseline_path = "experiment_data/subject_{0}/set_{1}/run_{2}/baseline/eeg.edf".format(subject_id - 1, set, run, type)
-    f = pyedflib.EdfReader(baseline_path)
-    n = f.signals_in_file
-    signal_labels = f.getSignalLabels()
-    baseline_eeg = np.zeros((n, f.getNSamples()[0]))
-    for i in np.arange(n):
-        baseline_eeg[i, :] = f.readSignal(i)
-
-    ipaf = np.mean(map(lambda samples: individual_peak_alpha(samples), [baseline_eeg[i] for i in peak_alpha_channels]))
-
-    baseline_frontal_alpha_power = np.mean(map(lambda samples: eeg_power(samples, ipaf), [baseline_eeg[i] for i in baseline_channels]))
-
-    trial_path = "experiment_data/subject_{0}/set_{1}/run_{2}/trial/eeg.edf".format(subject_id - 1, set, run, type)
-    f = pyedflib.EdfReader(trial_path)
-    n = f.signals_in_file
-    signal_labels = f.getSignalLabels()
-    trial_sham_eeg = np.zeros((n, f.getNSamples()[0]))
-    for i in np.arange(n):
-        trial_sham_eeg[i, :] = f.readSignal(i)
-
-    feedback_values = []
-    alpha_powers = []
-    feedback_length = (len(trial_sham_eeg[i]) / 125) * 60
-    # just do it sort of like the live versions
-
-    for frame in range(feedback_length):
-        buffer = map(lambda channel: channel[int(frame * round(sample_rate/60)):int((frame + 60) * round(sample_rate/60))], [trial_sham_eeg[i] for i in neurofeedback_channels])
-
-        buffer_alpha_powers = map(lambda channel: eeg_power(channel, ipaf), buffer)
-        alpha_power = np.mean(buffer_alpha_powers)
-        alpha_powers.append(alpha_power)
-        if frame % frames_per_bar == 0:  # make a new stimulus bar every frames_per_bar frames
-            feedback_values.append(neurofeedback_value(alpha_powers, baseline_frontal_alpha_power))
-    return feedback_values
-
-def stimuli_from_neurofeedback_values(win, values, neurofeedback_length, bar):
-    neurofeedback_stimuli = []
-    total_bars = ((neurofeedback_length) / frames_per_bar)
-    feedback_area_width = (window_x - window_x / 10)
-    bar_width = feedback_area_width / total_bars
-    last_neurofeedback_value = None
-
-    vertices = []
-    vertices.append([0 - feedback_area_width / 2, 0]) #the initial vertex
-
-    for index, value in enumerate(values[-(total_bars):]):
-        if last_neurofeedback_value is not None and value * last_neurofeedback_value < 0:  # it crossed over 0
-            a = [(index - 1) * bar_width - feedback_area_width / 2, last_neurofeedback_value]
-            b = [index * bar_width - feedback_area_width / 2, value]
-            slope = (b[1] - a[1]) / (b[0] - a[0])
-            x_int = a[0] - a[1] / slope
-            vertices.append([x_int, 0]) #the point where the line from the last value to the new value hits 0 to close the last polygon
-            neurofeedback_stimulus = visual.ShapeStim(
-                win=win,
-                vertices=vertices,
-                closeShape=True,
-                fillColor="white")
-            neurofeedback_stimuli.append(neurofeedback_stimulus)
-            vertices = []
-            vertices.append([x_int, 0]) #the point where the line from the last value to the new value hits 0 to start the new polygon
-            vertices.append(b) #the point for the new feedback stimulus
-        else:
-            vertices.append([index * bar_width - feedback_area_width / 2, value]) #the point for the new feedback stimulus
-        last_neurofeedback_value = value
-
-    vertices.append([bar * bar_width - feedback_area_width / 2, 0]) #the end vertex
-    neurofeedback_stimulus = visual.ShapeStim(
-        win=win,
-        vertices=vertices,
-        closeShape=True,
-        fillColor="white")
-    neurofeedback_stimuli.append(neurofeedback_stimulus)
-    for stimulus in neurofeedback_stimuli:  # shift and scale all existing stimuli
-        stimulus.pos += (bar_width / 2, 0)
-
-    return neurofeedback_stimuli
+# sham participants see the feedback computed from the previous subject's recording of the same run
+def sham_source_paths(subject_id, set, run):
+    path = "experiment_data/subject_{0}/set_{1}/run_{2}/{3}/eeg.edf"
+    return path.format(subject_id - 1, set, run, 'baseline'), path.format(subject_id - 1, set, run, 'trial')
+
+def feedback_values_from_eeg(sham_feedback, subject_id, set, run):
+    return sham_feedback.get(*sham_source_paths(subject_id, set, run))
+
+def feedback_graph(win, neurofeedback_length, values=()):
+    graph = FeedbackGraph(win, neurofeedback_length / frames_per_bar, window_x - window_x / 10)
+    graph.extend(values)
+    return graph
+
+# one frame of the feature stream: the band power of each feedback channel, their mean, the feedback value shown
+# and then the features of feature_registry; runs with fewer feedback channels than neurofeedback_channels, or
+# without a FeatureEngine, leave the remaining columns NaN
+def push_features(outlet, band_powers, feedback_value, features=()):
+    row = np.full(outlet.n_features, np.nan)
+    row[:len(band_powers)] = band_powers
+    n = len(neurofeedback_channels)
+    row[n:n + 2] = np.mean(band_powers), feedback_value
+    row[n + 2:n + 2 + len(features)] = features
+    outlet.push_features(row, local_clock())
+
+# a frame of a live run: the band powers, the newest bar's value and every registered feature
+def push_live_features(outlet, feedback, neurofeedback_values):
+    push_features(outlet, feedback.band_powers, neurofeedback_values[-1] if neurofeedback_values else np.nan,
+                  feedback.features())
 
 def baseline_line_stimulus(win):
     feedback_area_width = (window_x - window_x / 10)
@@ -1192,23 +1232,16 @@ def baseline_line_stimulus(win):
         fillColor="greenyellow",
         lineWidth=0)
 
-# returns the percentage that the current power is above the baseline power, smoothed by a gaussian
-def neurofeedback_value(power_values, baseline):
-    smoothing_window_size = 30
-    smoothed_alpha_powers = filters.gaussian_filter1d(power_values[len(power_values) - smoothing_window_size:], 1)
-    feedback_value = ((smoothed_alpha_powers[len(smoothed_alpha_powers) / 2] / baseline) - 1) * 100
-    if feedback_value > 250: # Cap feedback value at 250% of baseline, since those are certainly artifacts
-        feedback_value = 250.0
-    return feedback_value
-
 def connect_to_EEG():
     # first resolve an EEG stream on the lab network
     print("looking for an EEG stream...")
-    stream_bp_filtered = resolve_stream('name', 'OpenViBE Stream - Band Pass Filtered')
-    # streams = resolve_stream('type', 'EEG')
+    if filter_in_process:
+        streams = resolve_stream(*raw_eeg_stream)  # straight from the amplifier
+    else:
+        streams = resolve_stream('name', 'OpenViBE Stream - Band Pass Filtered')
     print("EEG stream connected")
     # create a new inlet to read from the stream
-    inlet = StreamInlet(stream_bp_filtered[0])
+    inlet = StreamInlet(streams[0])
 
 
     # make an outlet stream for markers
@@ -1216,8 +1249,14 @@ def connect_to_EEG():
     info = StreamInfo('MyMarkerStream', 'Markers', 1, 0, 'string', 'myuidw43536')
     print("Marker stream created")
     # next make an outlet
-    outlet = StreamOutlet(info)
-    return inlet, outlet
+    marker_outlet = StreamOutlet(info)
+
+    # and one for the band powers and feedback values of every frame
+    n_features = len(neurofeedback_channels) + 2 + len(feature_registry)
+    info = StreamInfo('NeurofeedbackFeatures', 'Features', n_features, 60, 'float32', 'neurofeedback_features')
+    feature_outlet = StreamOutlet(info)
+    print("Feature stream created")
+    return inlet, ExperimentOutlets(marker_outlet, feature_outlet, n_features, batch_size=frames_per_bar)
 
 def read_priming_stimuli():
     import csv
@@ -1246,45 +1285,42 @@ def save_participant_details(data, subject_id):
         writer.writerow(
             [data['age'], data['handedness'], data['gender'], data['sex'], data['dateStr'], data['group']])
 
-def save_edf(data, events, subject_id, set, run, type):
-    path = "experiment_data/subject_{0}/set_{1}/run_{2}/{3}".format(subject_id, set, run, type)
-    try:
-        os.makedirs(path)
-    except OSError as e:
-        if e.errno != errno.EEXIST:
-            raise
-
-    test_data_file = 'experiment_data/subject_{0}/set_{1}/run_{2}/{3}/eeg.edf'.format(subject_id, set, run, type)
-    f = pyedflib.EdfWriter(test_data_file, 16, file_type=pyedflib.FILETYPE_EDFPLUS)
-
-    # set header info
-    channel_info = []
-    for index, channel in enumerate(data):
-        channel_dict = {'label': index2channel[index],
-                        'dimension': 'uV',
-                        'sample_rate': sample_rate,
-                        'physical_max': 100,
-                        'physical_min': -100,
-                        'digital_max': 32767,
-                        'digital_min': -32768,
-                        'transducer': '',
-                        'prefilter':''}
-        channel_info.append(channel_dict)
-
-    f.setSignalHeaders(channel_info)
-    # write channel data
-    f.writeSamples(np.asarray(data))
-    f.close()
-    del f
+def open_recording(subject_id, set, run, type):
+    path = 'experiment_data/subject_{0}/set_{1}/run_{2}/{3}/eeg.edf'.format(subject_id, set, run, type)
+    return EdfRecording(path, channel_labels, sample_rate)
 
-    import csv
+# what the feedback of the trial after this baseline is computed from, and the baseline power to compare it with;
+# source feedback beamforms the baseline just recorded, so it needs to be closed first
+def select_feedback_channels(recording, set, run, baseline, ipaf):
+    if (set, run) not in source_feedback_runs:
+        return ChannelSelection(neurofeedback_channels), baseline
 
-    with open('experiment_data/subject_{0}/set_{1}/run_{2}/{3}/events.csv'.format(subject_id, set, run, type), 'wb') as csvfile:
-        writer = csv.writer(csvfile, delimiter=',',
-                            quotechar="|", quoting=csv.QUOTE_MINIMAL)
-        writer.writerow(["Latency", "Type", "Value"]) # header row
-        for event in events:
-            writer.writerow([event.latency, event.type, event.value])
+    f = EdfFile(recording.path)
+    try:
+        baseline_eeg = f.read(0, recording.n_samples)  # without the zeros padding the last record
+    finally:
+        f.close()
+    # the filter's covariance and its reference power come from the same samples: with artifact gating, the
+    # clean seconds of every channel if there are at least ten seconds of them, otherwise the whole baseline
+    clean, segments = None, [(0, baseline_eeg.shape[1])]
+    if artifact_gating:
+        clean_seconds = clean_segments(artifact_mask(baseline_eeg, sample_rate), sample_rate)
+        if sum(stop - start for start, stop in clean_seconds) >= 10 * sample_rate:
+            segments = clean_seconds
+            clean = np.zeros(baseline_eeg.shape[1], dtype=bool)
+            for start, stop in segments:
+                clean[start:stop] = True
+    feedback_channels = VirtualChannels(spatial_filter(baseline_eeg, channel_labels, leadfield=leadfield(), clean=clean))
+    baseline_power = segment_average(lambda eeg: eeg_power(feedback_channels.project(eeg), ipaf, method=spectral_method),
+                                     baseline_eeg, segments)
+    return feedback_channels, np.mean(baseline_power)
+
+def close_recording(recording, events, timer):
+    events.annotate()
+    recording.close()
+    path = os.path.dirname(recording.path)
+    events.save(os.path.join(path, 'events.npz'))
+    timer.save(os.path.join(path, 'timing.csv'))
 
 def further_instructions(win, section):
     message1 = visual.TextStim(win, pos=[0, +40], text='Please ask the research assistant for further instructions',
@@ -1309,14 +1345,5 @@ def thank_you_message(win):
     event.waitKeys()
 
 
-class EEGEvent:
-    latency = 0.0
-    type = ""
-    value = ""
-
-    def __init__(self, type, latency, value):
-        self.type = type
-        self.latency = latency
-        self.value = value
-
-main()
\ No newline at end of file
+if __name__ == '__main__':  # worker processes re-import this module on Windows
+    main()
\ No newline at end of file
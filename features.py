@@ -0,0 +1,119 @@
+from __future__ import division, print_function
+
+import collections
+
+import numpy as np
+import scipy.signal
+
+from eeg_buffer import RingBuffer
+
+# mean power in band (low <= f < high, Hz) over the channels labelled in channels
+BandFeature = collections.namedtuple('BandFeature', 'name band channels')
+# numerator / denominator, both names of band features
+RatioFeature = collections.namedtuple('RatioFeature', 'name numerator denominator')
+# log(right) - log(left), both names of band features; positive when right has more power
+AsymmetryFeature = collections.namedtuple('AsymmetryFeature', 'name left right')
+
+bands = {'delta': (1.0, 4.0),
+         'theta': (4.0, 8.0),
+         'alpha': (8.0, 13.0),
+         'beta': (13.0, 30.0)}
+
+channel_groups = {'frontal': ('Fp1', 'Fp2', 'Fpz', 'AF3', 'AF4', 'Fz'),
+                  'left_frontal': ('Fp1', 'AF3'),
+                  'right_frontal': ('Fp2', 'AF4'),
+                  'central': ('FC1', 'FC2', 'CP1', 'CP2'),
+                  'posterior': ('Oz', 'PO3', 'PO4', 'P3', 'P4', 'Pz')}
+
+# the features every FeatureEngine computes unless given others; add new metrics here
+feature_registry = [BandFeature('frontal_theta', bands['theta'], channel_groups['frontal']),
+                    BandFeature('frontal_alpha', bands['alpha'], channel_groups['frontal']),
+                    BandFeature('frontal_beta', bands['beta'], channel_groups['frontal']),
+                    BandFeature('left_frontal_alpha', bands['alpha'], channel_groups['left_frontal']),
+                    BandFeature('right_frontal_alpha', bands['alpha'], channel_groups['right_frontal']),
+                    BandFeature('central_beta', bands['beta'], channel_groups['central']),
+                    BandFeature('posterior_alpha', bands['alpha'], channel_groups['posterior']),
+                    BandFeature('posterior_theta', bands['theta'], channel_groups['posterior']),
+                    RatioFeature('frontal_theta_alpha_ratio', 'frontal_theta', 'frontal_alpha'),
+                    RatioFeature('posterior_theta_alpha_ratio', 'posterior_theta', 'posterior_alpha'),
+                    AsymmetryFeature('frontal_alpha_asymmetry', 'left_frontal_alpha', 'right_frontal_alpha')]
+
+
+class FeatureEngine(object):
+    """ Every registered feature of the newest window_length samples, all from one spectrum.
+
+    compute() takes a single Hann-windowed rfft of all channels. One matrix product turns it into
+    the power of every distinct band on every channel, and one more averages those over each band
+    feature's channels. Ratios and asymmetries are then elementwise operations on the band features,
+    so adding features adds rows to these matrices rather than more transforms. Like
+    SlidingBandPower.power(), compute() only recomputes once hop new samples have arrived.
+    """
+
+    def __init__(self, labels, sample_rate, window_length=None, features=None, hop=1):
+        self.labels = list(labels)
+        self.sample_rate = sample_rate
+        self.window_length = window_length or int(sample_rate)
+        self.hop = hop
+        self._values = None
+        self._version = 0  # self._window.total when _values were computed
+        features = feature_registry if features is None else features
+
+        band_features = [feature for feature in features if isinstance(feature, BandFeature)]
+        ratios = [feature for feature in features if isinstance(feature, RatioFeature)]
+        asymmetries = [feature for feature in features if isinstance(feature, AsymmetryFeature)]
+        self.names = [feature.name for feature in band_features + ratios + asymmetries]
+        index = dict((feature.name, i) for i, feature in enumerate(band_features))
+
+        # spectrum -> band power of each channel: (frequencies, distinct bands)
+        distinct = sorted(set(feature.band for feature in band_features))
+        freqs = np.fft.rfftfreq(self.window_length, 1.0 / sample_rate)
+        self._band_weights = np.array([(freqs >= low) & (freqs < high) for low, high in distinct], dtype=np.float64).T
+        self._feature_bands = np.array([distinct.index(feature.band) for feature in band_features], dtype=np.intp)
+
+        # band power of each channel -> mean over each feature's channels: (band features, channels)
+        self._channel_weights = np.zeros((len(band_features), len(self.labels)))
+        for i, feature in enumerate(band_features):
+            self._channel_weights[i, [self.labels.index(label) for label in feature.channels]] = 1.0 / len(feature.channels)
+
+        self._ratios = np.array([(index[f.numerator], index[f.denominator]) for f in ratios], dtype=np.intp).reshape(-1, 2)
+        self._asymmetries = np.array([(index[f.left], index[f.right]) for f in asymmetries], dtype=np.intp).reshape(-1, 2)
+
+        # one-sided power spectral density scaling of a Hann-windowed periodogram, times the bin width
+        self._taper = scipy.signal.get_window('hann', self.window_length)
+        scale = 2.0 / (sample_rate * (self._taper ** 2).sum()) * (sample_rate / self.window_length)
+        self._bin_scale = np.full(len(freqs), scale)
+        self._bin_scale[0] /= 2
+        if self.window_length % 2 == 0:
+            self._bin_scale[-1] /= 2
+        self._window = RingBuffer(len(self.labels), self.window_length, dtype=np.float64)
+
+    def update(self, samples):
+        """ Add a (samples, channels) block of new samples. """
+        self._window.append(samples)
+
+    def window(self):
+        return self._window.window()
+
+    def due(self):
+        """ Whether compute() will compute new values rather than return the cached ones. """
+        return self._values is None or self._window.total - self._version >= self.hop
+
+    def compute(self):
+        """ The value of every feature, in the order of names; NaN until the first window is full. """
+        if self.due():
+            self._values = self._compute()
+            self._version = self._window.total
+        return self._values
+
+    def _compute(self):
+        if len(self._window) < self.window_length:
+            return np.full(len(self.names), np.nan)
+        spectrum = np.fft.rfft(self._window.window() * self._taper, axis=-1)
+        power = (spectrum.real ** 2 + spectrum.imag ** 2) * self._bin_scale  # (channels, frequencies)
+        band_power = np.dot(power, self._band_weights)  # (channels, distinct bands)
+        values = (self._channel_weights * band_power[:, self._feature_bands].T).sum(axis=1)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratios = values[self._ratios[:, 0]] / values[self._ratios[:, 1]]
+            asymmetries = np.log(values[self._asymmetries[:, 1]]) - np.log(values[self._asymmetries[:, 0]])
+        return np.concatenate([values, ratios, asymmetries])
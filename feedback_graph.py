@@ -0,0 +1,88 @@
+from __future__ import division, print_function
+
+import collections
+import ctypes
+
+import numpy as np
+from pyglet import gl as GL
+
+
+class FeedbackGraph(object):
+    """ The filled feedback graph, kept as one triangle-strip vertex buffer and drawn in a single call.
+
+    Every value adds a (x, 0), (x, value) vertex pair, plus a pair at the zero crossing when the sign
+    changes, so appending a bar only writes the newest segment. Once more than total_bars values are
+    shown the oldest is dropped by moving the start of the strip, which scrolls the graph left.
+    pos and size behave like a ShapeStim's, so the graph can be moved and scaled like any other stimulus.
+    """
+
+    def __init__(self, win, total_bars, width, color=(1.0, 1.0, 1.0, 1.0)):
+        self.win = win
+        self.total_bars = total_bars
+        self.width = width
+        self.bar_width = width / total_bars
+        self.color = color
+        self.pos = np.array([0.0, 0.0])
+        self.size = np.array([1.0, 1.0])
+
+        self._vertices = np.zeros((4 * total_bars + 4, 2), dtype=np.float32)
+        self._count = 0  # vertices in use
+        self._starts = collections.deque()  # first vertex of each visible value
+        self._first_value = 0  # index of the oldest visible value
+        self._n_values = 0
+        self._last_value = None
+
+    def append(self, value):
+        x = self._n_values * self.bar_width
+        if self._last_value is not None and value * self._last_value < 0:  # it crossed over 0
+            # the point where the line from the last value to the new value hits 0
+            self._push(x - self.bar_width * value / (value - self._last_value), 0.0)
+        self._starts.append(self._count)
+        self._push(x, value)
+        self._n_values += 1
+        self._last_value = value
+
+        if len(self._starts) > self.total_bars:
+            self._starts.popleft()
+            self._first_value += 1
+
+    def extend(self, values):
+        for value in values:
+            self.append(value)
+
+    def _push(self, x, y):
+        if self._count + 2 > len(self._vertices):
+            self._make_room()
+        self._vertices[self._count] = (x, 0.0)
+        self._vertices[self._count + 1] = (x, y)
+        self._count += 2
+
+    def _make_room(self):
+        first = self._starts[0] if self._starts else self._count
+        if first >= len(self._vertices) // 2:  # mostly scrolled out: move the visible part to the front
+            self._vertices[:self._count - first] = self._vertices[first:self._count]
+            self._count -= first
+            self._starts = collections.deque(start - first for start in self._starts)
+        else:
+            grown = np.zeros((2 * len(self._vertices), 2), dtype=np.float32)
+            grown[:self._count] = self._vertices[:self._count]
+            self._vertices = grown
+
+    def draw(self):
+        if not self._starts:
+            return
+        first = self._starts[0]
+        vertices = self._vertices[first:self._count]
+        offset = -self._first_value * self.bar_width - self.width / 2 + self.bar_width / 2
+
+        self.win.setScale('pix')
+        GL.glPushMatrix()
+        GL.glTranslatef(self.pos[0], self.pos[1], 0)
+        GL.glScalef(self.size[0], self.size[1], 1)
+        GL.glTranslatef(offset, 0, 0)
+        GL.glColor4f(*self.color)
+        GL.glEnableClientState(GL.GL_VERTEX_ARRAY)
+        GL.glVertexPointer(2, GL.GL_FLOAT, 0, vertices.ctypes.data_as(ctypes.POINTER(GL.GLfloat)))
+        GL.glDrawArrays(GL.GL_TRIANGLE_STRIP, 0, len(vertices))
+        GL.glDisableClientState(GL.GL_VERTEX_ARRAY)
+        GL.glPopMatrix()
@@ -0,0 +1,123 @@
+from __future__ import division, print_function
+
+import numpy as np
+import scipy.ndimage
+from numpy.lib.stride_tricks import as_strided
+
+from artifacts import artifact_mask, clean_segments
+from eeg_processing import eeg_power, individual_peak_alpha, neurofeedback_value, segment_average, smoothing_window_size
+
+# part of every cache key of replayed results; increase it whenever a change here, or in what the
+# replay calls, changes what replay_run() returns for the same recordings and parameters
+replay_version = 5
+
+
+def live_updates(n_samples, sample_rate, n_frames, first_frame, frame_rate=60, hop=1):
+    """ The frames at which a live run fed a new band power to its smoother, and how many samples it had by each.
+
+    Samples are taken to arrive evenly, sample_rate / frame_rate of them per frame. LiveFeedback.frame()
+    runs on every frame from first_frame on, the end of the fixation, and computes a new power
+    whenever at least hop samples have arrived since it last did, as SlidingBandPower.due() decides.
+    """
+    arrived = np.minimum((np.arange(1, n_frames + 1) * int(sample_rate)) // int(frame_rate), n_samples)
+    frames = []
+    computed = None
+    for frame in range(first_frame, n_frames):
+        if computed is None or arrived[frame] - computed >= hop:
+            frames.append(frame)
+            computed = arrived[frame]
+    frames = np.array(frames, dtype=np.intp)
+    return frames, arrived[frames]
+
+
+def replay_alpha_powers(eeg, ipaf, stops, window_length, clean=None, method='periodogram', batch_size=1024):
+    """ Mean band power over channels of the window_length samples before each of stops, in a recorded (channels, samples) run.
+
+    These are the powers SlidingBandPower gives a live loop with stops samples received; windows
+    at the start of the run hold all the samples so far. The full-length windows go through
+    eeg_power() batch_size at a time, gathered from one strided view of eeg; the short ones are done
+    singly. With a clean mask over the samples, a window holding an artifact repeats the power of
+    the one before it, as LiveFeedback does with artifact gating.
+    """
+    eeg = np.ascontiguousarray(eeg, dtype=np.float64)
+    n_channels, n_samples = eeg.shape
+    stops = np.asarray(stops, dtype=np.intp)
+    starts = np.maximum(stops - window_length, 0)
+    alpha_powers = np.zeros(len(stops))
+
+    full = np.flatnonzero(stops >= window_length)
+    if len(full):
+        channel_stride, sample_stride = eeg.strides
+        windows = as_strided(eeg, shape=(n_channels, n_samples - window_length + 1, window_length),
+                             strides=(channel_stride, sample_stride, sample_stride))
+        for first in range(0, len(full), batch_size):
+            batch = full[first:first + batch_size]
+            alpha_powers[batch] = eeg_power(windows[:, starts[batch]], ipaf, method=method).mean(axis=0)
+    for index in np.flatnonzero(stops < window_length):
+        alpha_powers[index] = np.mean(eeg_power(eeg[:, :stops[index]], ipaf, method=method))
+
+    if clean is not None and len(stops):
+        rejected = np.concatenate([[0], np.cumsum(~np.asarray(clean, dtype=bool))])
+        kept = rejected[stops] == rejected[starts]
+        kept[0] = True  # the first power has no earlier one to repeat
+        alpha_powers = alpha_powers[np.maximum.accumulate(np.where(kept, np.arange(len(stops)), 0))]
+    return alpha_powers
+
+
+def replay_feedback_values(alpha_powers, baseline, bar_ends):
+    """ The neurofeedback_value() a live loop would have shown at each bar, the bar holding alpha_powers[:bar_end + 1]. """
+    alpha_powers = np.asarray(alpha_powers, dtype=np.float64)
+    bar_ends = np.asarray(bar_ends, dtype=np.intp)
+    feedback_values = np.zeros(len(bar_ends))
+
+    full = bar_ends + 1 >= smoothing_window_size
+    if full.any():
+        stride = alpha_powers.strides[0]
+        histories = as_strided(alpha_powers, shape=(len(alpha_powers) - smoothing_window_size + 1, smoothing_window_size),
+                               strides=(stride, stride))
+        histories = histories[bar_ends[full] - smoothing_window_size + 1]
+        smoothed = scipy.ndimage.gaussian_filter1d(histories, 1, axis=-1)[:, smoothing_window_size // 2]
+        feedback_values[full] = np.minimum(((smoothed / baseline) - 1) * 100, 250.0)
+
+    for index in np.flatnonzero(~full):  # bars before a full smoothing window exists
+        feedback_values[index] = neurofeedback_value(alpha_powers[:bar_ends[index] + 1], baseline)
+    return feedback_values.tolist()
+
+
+def replay_run(baseline_eeg, trial_eeg, parameters):
+    """ The IPAF, baseline power and feedback values a live participant would have got from a recorded run.
+
+    baseline_eeg and trial_eeg are (channels, samples) arrays; parameters holds the sample_rate,
+    frames_per_bar and the neurofeedback, baseline and peak alpha channel indices. If its
+    artifact_gating is set, artifacts found by the detector the live loops use are left out of the
+    baseline, whose estimates are then averaged over its clean segments, and gate the trial's
+    powers, as they do in live runs with experiment.artifact_gating. Its spectral_method picks the
+    eeg_power() estimator, the periodogram by default, and its power_hop is the live loops' (1 if
+    not given). frame_rate and fixation_frames, 60 and 120 if not given, place the trial's frames
+    as in the live loops, which feed their smoother through LiveFeedback.
+    """
+    sample_rate = parameters['sample_rate']
+    method = parameters.get('spectral_method', 'periodogram')
+    segments, trial_clean = [(0, baseline_eeg.shape[1])], None
+    if parameters.get('artifact_gating'):
+        segments = clean_segments(artifact_mask(baseline_eeg, sample_rate, parameters['baseline_channels']), sample_rate)
+        trial_clean = artifact_mask(trial_eeg, sample_rate, parameters['neurofeedback_channels'])
+
+    ipaf = np.mean(segment_average(individual_peak_alpha, baseline_eeg[parameters['peak_alpha_channels']], segments))
+    baseline_frontal_alpha_power = np.mean(segment_average(lambda eeg: eeg_power(eeg, ipaf, method=method),
+                                                           baseline_eeg[parameters['baseline_channels']], segments))
+
+    # the frames of the live loop, and when in them its smoother was fed a new power
+    frame_rate = parameters.get('frame_rate', 60)
+    n_frames = trial_eeg.shape[1] * frame_rate // sample_rate
+    first_frame = parameters.get('fixation_frames', 120)
+    update_frames, stops = live_updates(trial_eeg.shape[1], sample_rate, n_frames, first_frame, frame_rate,
+                                        parameters.get('power_hop', 1))
+    alpha_powers = replay_alpha_powers(trial_eeg[parameters['neurofeedback_channels']], ipaf, stops, sample_rate,
+                                       trial_clean, method)
+    # a bar every frames_per_bar-th frame after the fixation, showing the powers fed in up to that frame
+    bar_frames = np.arange(first_frame, n_frames)
+    bar_frames = bar_frames[bar_frames % parameters['frames_per_bar'] == 0]
+    bar_ends = np.searchsorted(update_frames, bar_frames, side='right') - 1
+    feedback_values = replay_feedback_values(alpha_powers, baseline_frontal_alpha_power, bar_ends[bar_ends >= 0])
+    return ipaf, baseline_frontal_alpha_power, feedback_values
@@ -0,0 +1,56 @@
+from __future__ import division, print_function
+
+import timeit
+
+import numpy as np
+
+from eeg_buffer import RingBuffer
+
+phases = ('pull_chunk', 'features', 'stimuli', 'draw', 'flip')
+
+
+class FrameTimer(object):
+    """ Records how long every frame of a trial loop spends in each phase, and which frames were dropped.
+
+    Call mark(phase) right after the code belonging to that phase; the time since the previous mark
+    is added to it. mark('flip') after win.flip() closes the frame. A frame counts as dropped when
+    the time from the previous flip is more than 1.5 refresh intervals.
+    """
+
+    def __init__(self, frame_rate=60, expected_frames=6000):
+        self.frame_rate = frame_rate
+        self.expected_frames = expected_frames
+        self.reset()
+
+    def reset(self):
+        self._frames = RingBuffer(len(phases) + 1, self.expected_frames, dtype=np.float64, growable=True)
+        self._current = np.zeros(len(phases) + 1)
+        self._last = self._last_flip = timeit.default_timer()
+        self.dropped_frames = 0
+
+    def start(self):
+        """ Call just before a trial loop so the first frame does not include the wait before it. """
+        self._last = self._last_flip = timeit.default_timer()
+
+    def mark(self, phase):
+        now = timeit.default_timer()
+        self._current[phases.index(phase)] += now - self._last
+        self._last = now
+        if phase == 'flip':
+            self._current[-1] = now - self._last_flip
+            if self._current[-1] > 1.5 / self.frame_rate:
+                self.dropped_frames += 1
+            self._frames.append(self._current)
+            self._current = np.zeros(len(phases) + 1)
+            self._last_flip = now
+
+    def save(self, path):
+        """ Writes one row per frame, all times in milliseconds, then starts over for the next run. """
+        frames = self._frames.data().T * 1000
+        dropped = frames[:, -1] > 1500.0 / self.frame_rate
+        table = np.column_stack([np.arange(len(frames)), frames, dropped])
+        header = ','.join(('frame',) + tuple(phase + '_ms' for phase in phases) + ('frame_ms', 'dropped'))
+        np.savetxt(path, table, fmt=['%d'] + ['%.3f'] * (len(phases) + 1) + ['%d'], delimiter=',',
+                   header=header, comments='')
+        print("{0} of {1} frames dropped".format(self.dropped_frames, len(frames)))
+        self.reset()
@@ -0,0 +1,51 @@
+from __future__ import division, print_function
+
+import numpy as np
+
+from artifacts import ArtifactDetector
+from eeg_processing import FeedbackSmoother, SlidingBandPower
+from features import FeatureEngine
+
+
+class LiveFeedback(object):
+    """ The feedback of a live run, from the chunks of every recorded channel as they arrive.
+
+    update() adds each chunk to the band power of the feedback channels and to the FeatureEngine of
+    the feature stream. frame() is called once per feedback frame:
+    when new samples have arrived, it adds the mean band power to the smoother. With
+    artifact_gating, the last clean power is repeated instead while the window holds artifacts.
+    value() is then the smoothed feedback value.
+    """
+
+    def __init__(self, labels, feedback_channels, ipaf, baseline, sample_rate, method='periodogram', hop=1,
+                 artifact_gating=False):
+        self.feedback_channels = feedback_channels  # a ChannelSelection or VirtualChannels
+        self.band_power = SlidingBandPower(feedback_channels.n_channels, ipaf, window_length=sample_rate,  # last second of samples
+                                           method=method, hop=hop)
+        self.artifact_detector = ArtifactDetector(len(labels), sample_rate, feedback_channels.channels) if artifact_gating else None
+        self.smoother = FeedbackSmoother(baseline)  # keeps only the powers the smoothing needs
+        self.feature_engine = FeatureEngine(labels, sample_rate, hop=hop)  # the other metrics, for the feature stream
+        self.band_powers = None  # of the feedback channels, as of the last frame()
+        self._alpha_power = None
+
+    def update(self, samples):
+        """ Add a (samples, channels) chunk of every recorded channel. """
+        clean = self.artifact_detector.update(samples) if self.artifact_detector is not None else None
+        self.band_power.update(self.feedback_channels(samples), clean)
+        self.feature_engine.update(samples)
+
+    def frame(self):
+        """ Bring band_powers and the smoother up to date; frames without new samples add nothing to the smoothing. """
+        new_power = self.band_power.due()
+        self.band_powers = self.band_power.power()
+        if new_power:
+            if self._alpha_power is None or self.band_power.clean():  # otherwise repeat the last clean power
+                self._alpha_power = np.mean(self.band_powers)
+            self.smoother.update(self._alpha_power)
+
+    def value(self):
+        return self.smoother.value()
+
+    def features(self):
+        """ Every registered feature of the newest second, for the feature stream. """
+        return self.feature_engine.compute()
@@ -0,0 +1,39 @@
+from __future__ import division, print_function
+
+import numpy as np
+
+
+class ExperimentOutlets(object):
+    """ The two LSL streams the experiment publishes: string markers and per-frame features.
+
+    push_sample() sends a marker straight away, like the StreamOutlet it wraps, so it can be used
+    wherever the marker outlet was. Feature rows are collected by push_features() and sent with a
+    single push_chunk() every batch_size frames; any rows still waiting are sent before a marker,
+    so a recorder sees the features of a bar before the marker that ends it.
+    """
+
+    def __init__(self, marker_outlet, feature_outlet, n_features, batch_size=30):
+        self.markers = marker_outlet
+        self.features = feature_outlet
+        self.n_features = n_features
+        self._rows = np.zeros((batch_size, n_features), dtype=np.float32)
+        self._last_time = 0.0
+        self._count = 0
+
+    def push_sample(self, sample, timestamp=0.0):
+        self.flush()
+        self.markers.push_sample(sample, timestamp)
+
+    def push_features(self, row, timestamp):
+        """ Queue one frame's features; timestamp is when the frame's data was taken, on the LSL clock. """
+        self._rows[self._count] = row
+        self._last_time = timestamp
+        self._count += 1
+        if self._count == len(self._rows):
+            self.flush()
+
+    def flush(self):
+        if self._count:
+            # LSL dates the earlier rows back from the last one at the stream's nominal rate
+            self.features.push_chunk(self._rows[:self._count].tolist(), self._last_time)
+            self._count = 0
@@ -0,0 +1,51 @@
+from __future__ import division, print_function
+
+import numpy as np
+import scipy.signal
+
+
+class OnlineFilter(object):
+    """ Causal band-pass, band-stop and re-reference of a raw EEG stream, a chunk at a time.
+
+    The defaults are the Butterworth filters of test_acquisition.xml, so the output matches what
+    OpenViBE published as 'OpenViBE Stream - Band Pass Filtered'. All filters are cascaded into one
+    set of second-order sections whose state is kept between chunks; every chunk is filtered on
+    all channels at once. The state starts from the steady state of the first sample, so the DC
+    offset of a raw amplifier does not ring through the band-pass.
+
+    reference is None to leave the channels as they are, 'average' for an average reference, or a
+    list of channel indices whose mean is subtracted from every channel.
+    """
+
+    def __init__(self, n_channels, sample_rate, band=(1.0, 58.0), notch=(58.0, 62.0), order=4, reference=None):
+        self.n_channels = n_channels
+        self.sample_rate = sample_rate
+        self.reference = reference
+        nyquist = sample_rate / 2.0
+        sections = []
+        if notch is not None:
+            sections.append(scipy.signal.butter(order, [notch[0] / nyquist, min(notch[1] / nyquist, 0.99)],
+                                                btype='bandstop', output='sos'))
+        if band is not None:
+            sections.append(scipy.signal.butter(order, [band[0] / nyquist, min(band[1] / nyquist, 0.99)],
+                                                btype='bandpass', output='sos'))
+        self.sos = np.concatenate(sections) if sections else np.array([[1.0, 0, 0, 1.0, 0, 0]])
+        self._zi = None
+
+    def reset(self):
+        self._zi = None
+
+    def process(self, samples):
+        """ Filters a (samples, channels) chunk and returns it, continuing from the end of the previous one. """
+        samples = np.asarray(samples, dtype=np.float64).reshape(-1, self.n_channels)
+        if not len(samples):
+            return samples
+        if self.reference == 'average':
+            samples = samples - samples.mean(axis=1, keepdims=True)
+        elif self.reference is not None:
+            samples = samples - samples[:, self.reference].mean(axis=1, keepdims=True)
+
+        if self._zi is None:  # (sections, 2, channels), as if the first sample had always been there
+            self._zi = scipy.signal.sosfilt_zi(self.sos)[:, :, np.newaxis] * samples[0]
+        filtered, self._zi = scipy.signal.sosfilt(self.sos, samples, axis=0, zi=self._zi)
+        return filtered
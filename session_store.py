@@ -0,0 +1,229 @@
+from __future__ import division, print_function
+
+import csv
+import glob
+import os
+import re
+
+import numpy as np
+
+from edf_reader import EdfFile
+from event_log import recorded_samples, text_types
+
+catalog_dtype = np.dtype([('subject', np.int32),
+                          ('group', 'U16'),
+                          ('set', np.int32),
+                          ('run', np.int32),
+                          ('type', 'U8'),  # baseline or trial
+                          ('entry', np.int32),  # row of this run in its subject's store
+                          ('sample_rate', np.float64),
+                          ('n_samples', np.int64),
+                          ('duration', np.float64),  # seconds
+                          ('start', np.int64),  # first sample of the run in the subject's concatenated eeg
+                          ('events_start', np.int64),
+                          ('events_stop', np.int64)])
+
+event_dtype = np.dtype([('entry', np.int32),
+                        ('time', np.float64),  # seconds from the start of the run
+                        ('sample', np.int64),
+                        ('type', 'U32'),
+                        ('value', 'U64')])
+
+question_dtype = np.dtype([('set', np.int32),
+                           ('run', np.int32),
+                           ('question', np.int32),
+                           ('value', 'U64')])
+
+
+def read_run_events(directory, sample_rate):
+    """ The events of one run directory as (time, sample, type, value) tuples, from events.npz or the older events.csv. """
+    if os.path.exists(os.path.join(directory, 'events.npz')):
+        log = np.load(os.path.join(directory, 'events.npz'))
+        types, texts = log['types'], log['texts']
+        events = []
+        for event in log['events']:
+            type = str(types[event['type']])
+            value = texts[int(event['value'])] if type in text_types else '{0:g}'.format(event['value'])
+            events.append((event['sample'] / sample_rate, event['sample'], type, value))
+        return events
+    if os.path.exists(os.path.join(directory, 'events.csv')):
+        with open(os.path.join(directory, 'events.csv')) as f:
+            return [(float(row['Latency']), int(round(float(row['Latency']) * sample_rate)), row['Type'], row['Value'])
+                    for row in csv.DictReader(f)]
+    return []
+
+
+def read_questions(path):
+    with open(path) as f:
+        return [(int(row['question']), row['value']) for row in csv.DictReader(f)]
+
+
+def read_group(subject_directory):
+    path = os.path.join(subject_directory, 'participant_info.csv')
+    if not os.path.exists(path):
+        return ''
+    with open(path) as f:
+        rows = list(csv.DictReader(f, quotechar='|'))
+    return rows[0]['group'] if rows else ''
+
+
+def subject_runs(subject_directory):
+    """ (set, run, type, directory) of every recorded run of a subject, in the order they were run. """
+    runs = []
+    for path in glob.glob(os.path.join(subject_directory, 'set_*', 'run_*', '*', 'eeg.edf')):
+        directory = os.path.dirname(path)
+        match = re.search(r'set_(\d+)[/\\]run_(\d+)[/\\](\w+)$', directory)
+        if match:
+            runs.append((int(match.group(1)), int(match.group(2)), match.group(3), directory))
+    return sorted(runs, key=lambda run: (run[0], run[1], run[2] != 'baseline', run[2]))
+
+
+def write_subject(subject_directory, path, chunk_seconds=60):
+    """ Packs every run of a subject into one compressed .npz and returns its catalog.
+
+    The EEG of all runs is concatenated and stored as the int16 values of the EDF files, split into
+    chunk_seconds long members so that reading one run only decompresses the chunks it overlaps.
+    Each run's gain and offset turn them back into microvolts.
+    """
+    subject = int(re.search(r'subject_(\d+)', subject_directory).group(1))
+    group = read_group(subject_directory)
+    runs = subject_runs(subject_directory)
+
+    catalog = np.zeros(len(runs), dtype=catalog_dtype)
+    eeg, gains, offsets, events, questions = [], [], [], [], []
+    labels = []
+    start = 0
+    for entry, (set, run, type, directory) in enumerate(runs):
+        edf_path = os.path.join(directory, 'eeg.edf')
+        f = EdfFile(edf_path)
+        try:
+            eeg.append(f.read_digital(0, recorded_samples(edf_path)))
+            gains.append(f.gain)
+            offsets.append(f.offset)
+            labels = labels or f.labels
+            sample_rate, n_samples = f.sample_rate, eeg[-1].shape[1]
+        finally:
+            f.close()
+        run_events = read_run_events(directory, sample_rate)
+        catalog[entry] = (subject, group, set, run, type, entry, sample_rate, n_samples, n_samples / sample_rate,
+                          start, len(events), len(events) + len(run_events))
+        events.extend((entry,) + event for event in run_events)
+        start += n_samples
+
+        questions_path = os.path.join(os.path.dirname(directory), 'questions.csv')
+        if type == 'trial' and os.path.exists(questions_path):
+            questions.extend((set, run) + answer for answer in read_questions(questions_path))
+
+    eeg = np.concatenate(eeg, axis=1) if eeg else np.zeros((0, 0), dtype=np.int16)
+    chunk_samples = int(chunk_seconds * (catalog['sample_rate'].max() if len(catalog) else 1))
+    members = {'catalog': catalog,
+               'labels': np.array(labels),
+               'gain': np.array(gains),
+               'offset': np.array(offsets),
+               'events': np.array(events, dtype=event_dtype),
+               'questions': np.array(questions, dtype=question_dtype),
+               'chunk_samples': np.array(chunk_samples)}
+    for index, first in enumerate(range(0, eeg.shape[1], chunk_samples)):
+        members['eeg_{0:05d}'.format(index)] = eeg[:, first:first + chunk_samples]
+
+    temporary_path = '{0}.{1}.tmp.npz'.format(path[:-len('.npz')], os.getpid())
+    np.savez_compressed(temporary_path, **members)
+    if hasattr(os, 'replace'):
+        os.replace(temporary_path, path)
+    else:
+        try:  # Python 2: rename() replaces the old container atomically everywhere but on Windows
+            os.rename(temporary_path, path)
+        except OSError:
+            os.remove(path)
+            os.rename(temporary_path, path)
+    return catalog
+
+
+class SessionStore(object):
+    """ All subjects' runs, one compressed container per subject, with one catalog of every run.
+
+    catalog() answers which runs exist, how long they are and which group the subject was in from a
+    single file; eeg(), events() and questions() then open only the subject's container, and only
+    the parts of it that the run needs.
+    """
+
+    def __init__(self, directory='experiment_data/sessions'):
+        self.directory = directory
+        self._subjects = {}
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+        catalog_path = os.path.join(directory, 'catalog.npy')
+        self._catalog = np.load(catalog_path) if os.path.exists(catalog_path) else np.zeros(0, dtype=catalog_dtype)
+
+    def subject_path(self, subject):
+        return os.path.join(self.directory, 'subject_{0}.npz'.format(subject))
+
+    def add_subject(self, subject_directory):
+        """ (Re)packs one subject directory of experiment_data and updates the catalog. """
+        subject = int(re.search(r'subject_(\d+)', subject_directory).group(1))
+        self._close_subject(subject)
+        catalog = write_subject(subject_directory, self.subject_path(subject))
+        self._catalog = np.concatenate([self._catalog[self._catalog['subject'] != subject], catalog])
+        np.save(os.path.join(self.directory, 'catalog.npy'), self._catalog)
+
+    def catalog(self, **query):
+        """ The catalog rows matching every given column value, e.g. catalog(set=2, type='trial'). """
+        selected = np.ones(len(self._catalog), dtype=bool)
+        for column, value in query.items():
+            selected &= self._catalog[column] == value
+        return self._catalog[selected]
+
+    def eeg(self, run, start=0, stop=None, channels=None):
+        """ Samples start to stop of a catalog row's run, in microvolts, as a (channels, samples) array. """
+        store = self._subject(run['subject'])
+        stop = run['n_samples'] if stop is None else min(stop, run['n_samples'])
+        start = min(max(start, 0), stop)
+        chunk_samples = int(store['chunk_samples'])
+        first, last = run['start'] + start, run['start'] + stop
+
+        chunks = [store['eeg_{0:05d}'.format(index)]
+                  for index in range(first // chunk_samples, -(-last // chunk_samples))]
+        digital = np.concatenate(chunks, axis=1) if chunks else np.zeros((len(store['labels']), 0), dtype=np.int16)
+        digital = digital[:, first - (first // chunk_samples) * chunk_samples:][:, :last - first]
+
+        gain, offset = store['gain'][run['entry']], store['offset'][run['entry']]
+        if channels is not None:
+            digital, gain, offset = digital[channels], gain[channels], offset[channels]
+        return gain[:, np.newaxis] * (digital + offset[:, np.newaxis])
+
+    def events(self, run):
+        return self._subject(run['subject'])['events'][run['events_start']:run['events_stop']]
+
+    def questions(self, run):
+        questions = self._subject(run['subject'])['questions']
+        return questions[(questions['set'] == run['set']) & (questions['run'] == run['run'])]
+
+    def _subject(self, subject):
+        if subject not in self._subjects:
+            self._subjects[subject] = np.load(self.subject_path(subject))
+        return self._subjects[subject]
+
+    def _close_subject(self, subject):
+        store = self._subjects.pop(subject, None)
+        if store is not None:
+            store.close()
+
+    def close(self):
+        for subject in list(self._subjects):
+            self._close_subject(subject)
+
+
+def main():
+    store = SessionStore()
+    for subject_directory in sorted(glob.glob('experiment_data/subject_*')):
+        print("packing {0}".format(subject_directory))
+        store.add_subject(subject_directory)
+    print("{0} runs in {1}".format(len(store.catalog()), store.directory))
+    store.close()
+
+
+if __name__ == '__main__':
+    main()
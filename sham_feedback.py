@@ -0,0 +1,102 @@
+from __future__ import division, print_function
+
+import hashlib
+import multiprocessing
+import os
+
+import numpy as np
+
+from edf_reader import read_edf
+from event_log import recorded_samples
+from feedback_replay import replay_run, replay_version
+
+
+def sham_feedback_values(baseline_path, trial_path, parameters):
+    """ The feedback values a live participant would have seen during the recorded trial. """
+    return replay_run(read_edf(baseline_path, recorded_samples(baseline_path)),
+                      read_edf(trial_path, recorded_samples(trial_path)), parameters)[2]
+
+
+def content_digest(parameters, paths):
+    """ A SHA-1 hex digest of the parameters and the bytes of every file in paths. """
+    digest = hashlib.sha1(repr(sorted(parameters.items())).encode('utf-8'))
+    for path in paths:
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def _lower_priority():
+    """ Pool initializer: replays run below the experiment's priority, so they do not take frames from it. """
+    if hasattr(os, 'nice'):
+        os.nice(10)
+    else:  # Windows
+        import ctypes
+        kernel32 = ctypes.windll.kernel32
+        kernel32.SetPriorityClass(kernel32.GetCurrentProcess(), 0x4000)  # BELOW_NORMAL_PRIORITY_CLASS
+
+
+def _compute_and_store(baseline_path, trial_path, parameters, cache_path):
+    feedback_values = sham_feedback_values(baseline_path, trial_path, parameters)
+    temporary_path = '{0}.{1}.tmp'.format(cache_path, os.getpid())
+    with open(temporary_path, 'wb') as f:
+        np.save(f, np.asarray(feedback_values))
+    try:
+        os.rename(temporary_path, cache_path)
+    except OSError:  # another process stored the same trace first
+        os.remove(temporary_path)
+    return feedback_values
+
+
+class ShamFeedbackCache(object):
+    """ Sham feedback traces computed ahead of time in a process pool and kept on disk.
+
+    Traces are stored under a hash of both source EDF files, the analysis parameters and the
+    replay_version, so a restarted session, or a later one reusing the same recordings, just loads
+    them. The pool has a single low-priority worker by default, as it runs alongside the first runs.
+    """
+
+    def __init__(self, directory, parameters, processes=1):
+        self.directory = directory
+        self.parameters = dict(parameters, replay_version=replay_version)
+        self.processes = processes
+        self._pool = None
+        self._pending = {}
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+
+    def cache_path(self, baseline_path, trial_path):
+        return os.path.join(self.directory, content_digest(self.parameters, (baseline_path, trial_path)) + '.npy')
+
+    def precompute(self, sources):
+        """ Start computing every (baseline_path, trial_path) trace that exists and is not cached yet. """
+        for baseline_path, trial_path in sources:
+            if not (os.path.exists(baseline_path) and os.path.exists(trial_path)):
+                continue
+            cache_path = self.cache_path(baseline_path, trial_path)
+            if os.path.exists(cache_path) or cache_path in self._pending:
+                continue
+            if self._pool is None:
+                self._pool = multiprocessing.Pool(self.processes, initializer=_lower_priority)
+            self._pending[cache_path] = self._pool.apply_async(
+                _compute_and_store, (baseline_path, trial_path, self.parameters, cache_path))
+
+    def get(self, baseline_path, trial_path):
+        """ The trace for these recordings, waiting for or computing it if it is not on disk yet. """
+        cache_path = self.cache_path(baseline_path, trial_path)
+        if cache_path in self._pending:
+            return self._pending.pop(cache_path).get()
+        if os.path.exists(cache_path):
+            return np.load(cache_path).tolist()
+        return _compute_and_store(baseline_path, trial_path, self.parameters, cache_path)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+        self._pending = {}
@@ -0,0 +1,98 @@
+from __future__ import division, print_function
+
+import numpy as np
+import scipy.io
+
+pcc_position = (-6, -60, 18)  # mm, the posterior cingulate point create_spatial_filter.m beamforms to
+
+
+class Leadfield(object):
+    """ The FieldTrip lead fields shipped in leadfield.mat, on the source grid of sourcemodel.mat.
+
+    gains holds one (channels, 3) lead field per grid point inside the head, in the order of
+    positions; select() restricts them to the channels actually recorded.
+    """
+
+    def __init__(self, leadfield_path='leadfield.mat', sourcemodel_path='sourcemodel.mat'):
+        sourcemodel = scipy.io.loadmat(sourcemodel_path, squeeze_me=True, struct_as_record=False)['sourcemodel']
+        leadfield = scipy.io.loadmat(leadfield_path, squeeze_me=True, struct_as_record=False)['leadfield']
+        inside = np.asarray(sourcemodel.inside, dtype=bool)
+        if not np.array_equal(np.asarray(leadfield.pos), np.asarray(sourcemodel.pos)):
+            raise ValueError("{0} was not computed on the grid of {1}".format(leadfield_path, sourcemodel_path))
+
+        self.unit = sourcemodel.unit
+        self.positions = np.asarray(sourcemodel.pos, dtype=np.float64)[inside]
+        self.labels = [str(label) for label in leadfield.label]
+        self.gains = np.array([leadfield.leadfield[index] for index in np.flatnonzero(inside)], dtype=np.float64)
+
+    def select(self, labels):
+        """ The lead fields of the given channels, re-referenced to their average like the data is: (positions, channels, 3). """
+        gains = self.gains[:, [self.labels.index(label) for label in labels], :]
+        return gains - gains.mean(axis=1, keepdims=True)
+
+    def nearest(self, position):
+        """ Index of the grid point closest to position (in the grid's unit). """
+        return int(np.argmin(((self.positions - np.asarray(position, dtype=np.float64)) ** 2).sum(axis=1)))
+
+
+def baseline_covariance(eeg, clean=None):
+    """ Channel covariance of a (channels, samples) recording after an average reference and demeaning.
+
+    clean, a boolean mask over samples, leaves artifact samples out of the estimate.
+    """
+    eeg = np.asarray(eeg, dtype=np.float64)
+    if clean is not None:
+        eeg = eeg[:, clean]
+    eeg = eeg - eeg.mean(axis=0)  # average reference
+    eeg = eeg - eeg.mean(axis=1, keepdims=True)
+    return np.dot(eeg, eeg.T) / max(1, eeg.shape[1] - 1)
+
+
+def lcmv_filters(gains, covariance, regularization=0.05, reduce_rank=None, fixed_orientation=False):
+    """ LCMV beamformer weights for every lead field in gains, as (positions, orientations, channels).
+
+    The same filter FieldTrip's beamformer_lcmv computes: W = pinv(L' C^-1 L) L' C^-1, with
+    regularization * mean eigenvalue added to the diagonal of C first (the average reference
+    leaves it rank-deficient). reduce_rank keeps only that many singular values of each lead
+    field; fixed_orientation projects each filter onto its orientation of largest power,
+    giving one virtual channel per position. All positions are solved as one stacked problem.
+    """
+    gains = np.asarray(gains, dtype=np.float64)
+    n_channels = covariance.shape[0]
+    regularized = covariance + regularization * np.trace(covariance) / n_channels * np.eye(n_channels)
+    inverse_covariance = np.linalg.pinv(regularized)
+
+    if reduce_rank is not None and reduce_rank < gains.shape[-1]:
+        u, s, vt = np.linalg.svd(gains, full_matrices=False)
+        gains = np.matmul(u[..., :reduce_rank] * s[..., np.newaxis, :reduce_rank], vt[..., :reduce_rank, :])
+
+    gains_t = np.swapaxes(gains, -1, -2)
+    projected = np.matmul(gains_t, inverse_covariance)  # L' C^-1
+    filters = np.matmul(np.linalg.pinv(np.matmul(projected, gains)), projected)
+
+    if fixed_orientation:
+        power = np.matmul(np.matmul(filters, covariance), np.swapaxes(filters, -1, -2))
+        values, vectors = np.linalg.eigh(power)
+        orientation = vectors[..., :, -1:]  # eigh sorts ascending, so the last one has the most power
+        filters = np.matmul(np.swapaxes(orientation, -1, -2), filters)
+    return filters
+
+
+def source_power(filters, covariance):
+    """ Power of each position's filtered signal, the trace of W C W'. """
+    return np.einsum('poc,cd,pod->p', filters, covariance, filters)
+
+
+def spatial_filter(baseline_eeg, labels, position=pcc_position, leadfield=None, clean=None,
+                   regularization=0.05, reduce_rank=None, fixed_orientation=True):
+    """ Beamformer weights for the grid point nearest position from a baseline recording, as (virtual channels, channels).
+
+    The average reference is folded into the weights, so multiplying them with a (channels, samples)
+    block of the same channels, as recorded, gives the virtual channel(s) at that point.
+    """
+    leadfield = leadfield or Leadfield()
+    index = leadfield.nearest(position)
+    covariance = baseline_covariance(baseline_eeg, clean)
+    gains = leadfield.select(labels)[index:index + 1]
+    weights = lcmv_filters(gains, covariance, regularization, reduce_rank, fixed_orientation)[0]
+    return weights - weights.mean(axis=-1, keepdims=True)
@@ -0,0 +1,72 @@
+from __future__ import division, print_function
+
+import contextlib
+import threading
+import timeit
+
+
+class StartupReport(object):
+    """ How long each named step of starting the experiment took, printed as one table. """
+
+    def __init__(self):
+        self.steps = []
+
+    @contextlib.contextmanager
+    def step(self, name):
+        start = timeit.default_timer()
+        try:
+            yield
+        finally:
+            self.steps.append((name, timeit.default_timer() - start))
+
+    def print_summary(self):
+        width = max([len(name) for name, seconds in self.steps] + [len('total')])
+        print("startup:")
+        for name, seconds in self.steps:
+            print("  {0:<{1}} {2:8.0f} ms".format(name, width, seconds * 1000))
+        print("  {0:<{1}} {2:8.0f} ms".format('total', width, sum(seconds for name, seconds in self.steps) * 1000))
+
+
+class BackgroundTask(object):
+    """ Calls function(*args) on a daemon thread straight away; result() waits for it and returns its value.
+
+    An exception raised by the function is raised again from result(), on the caller's thread.
+    """
+
+    def __init__(self, function, *args):
+        self._function = function
+        self._args = args
+        self._value = None
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name='background-' + function.__name__)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        try:
+            self._value = self._function(*self._args)
+        except Exception as e:
+            self._error = e
+
+    def result(self):
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+
+class LazyValue(object):
+    """ Calls function() the first time the value is asked for, and keeps what it returned. """
+
+    def __init__(self, function):
+        self._function = function
+        self._lock = threading.Lock()
+        self._done = False
+        self._value = None
+
+    def __call__(self):
+        with self._lock:
+            if not self._done:
+                self._value = self._function()
+                self._done = True
+        return self._value
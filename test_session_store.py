@@ -0,0 +1,71 @@
+from __future__ import division, print_function
+
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from edf_reader import EdfFile
+from session_store import SessionStore, write_subject
+
+subject_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'experiment_data', 'subject_1')
+
+
+def tree_digests(directory):
+    """ SHA-1 of every file under directory, by path relative to it. """
+    digests = {}
+    for root, _, names in os.walk(directory):
+        for name in names:
+            path = os.path.join(root, name)
+            with open(path, 'rb') as f:
+                digests[os.path.relpath(path, directory)] = hashlib.sha1(f.read()).hexdigest()
+    return digests
+
+
+@unittest.skipUnless(os.path.isdir(subject_directory), 'needs experiment_data/subject_1')
+class WriteSubjectTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.subject_directory = os.path.join(self.directory, 'data', 'subject_1')
+        shutil.copytree(subject_directory, self.subject_directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_leaves_recordings_untouched(self):
+        before = tree_digests(self.subject_directory)
+        path = os.path.join(self.directory, 'subject_1.npz')
+        write_subject(self.subject_directory, path)
+        self.assertTrue(os.path.isfile(path))
+        self.assertEqual(tree_digests(self.subject_directory), before)
+
+    def test_replaces_existing_container(self):
+        path = os.path.join(self.directory, 'subject_1.npz')
+        with open(path, 'wb') as f:
+            f.write(b'stale')
+        catalog = write_subject(self.subject_directory, path)
+        with np.load(path) as store:
+            self.assertEqual(len(store['catalog']), len(catalog))
+        self.assertEqual(sorted(os.listdir(self.directory)), ['data', 'subject_1.npz'])
+
+    def test_round_trip(self):
+        store = SessionStore(os.path.join(self.directory, 'sessions'))
+        store.add_subject(self.subject_directory)
+        try:
+            for run in store.catalog():
+                f = EdfFile(os.path.join(self.subject_directory, 'set_{0}'.format(run['set']),
+                                         'run_{0}'.format(run['run']), run['type'], 'eeg.edf'))
+                try:
+                    np.testing.assert_array_equal(store.eeg(run), f.read(0, run['n_samples']))
+                finally:
+                    f.close()
+        finally:
+            store.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,41 @@
+from __future__ import division, print_function
+
+import numpy as np
+
+
+class ChannelSelection(object):
+    """ Feedback computed from a subset of the recorded scalp channels. """
+
+    def __init__(self, channels):
+        self.channels = list(channels)
+        self.n_channels = len(self.channels)
+
+    def __call__(self, samples):
+        """ The selected columns of a (samples, channels) chunk. """
+        return samples[:, self.channels]
+
+    def project(self, eeg):
+        """ The selected rows of a (channels, samples) recording. """
+        return eeg[self.channels]
+
+
+class VirtualChannels(object):
+    """ Feedback computed from virtual channels, each a weighted sum of all the recorded channels.
+
+    weights is a (virtual channels, channels) matrix such as spatial_filter() returns, so a whole
+    chunk is projected with a single matrix multiply.
+    """
+
+    def __init__(self, weights):
+        self.weights = np.atleast_2d(np.asarray(weights, dtype=np.float64))
+        self.n_channels = len(self.weights)
+        self.channels = list(range(self.weights.shape[1]))  # the recorded channels they draw on: all of them
+        self._weights_t = np.ascontiguousarray(self.weights.T)
+
+    def __call__(self, samples):
+        """ A (samples, channels) chunk as (samples, virtual channels). """
+        return np.dot(samples, self._weights_t)
+
+    def project(self, eeg):
+        """ A (channels, samples) recording as (virtual channels, samples). """
+        return np.dot(self.weights, eeg)